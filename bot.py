@@ -1,24 +1,23 @@
+import asyncio
 import html
 import logging
 
-from aiogram import Bot, Dispatcher, executor, types
+from aiogram import Bot, Dispatcher, types
 from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from utils.config import cfg
 from utils.database import Database
+from utils.tenants import Tenant, current_tenant, load_tenants
 from bot.prompt_engineer import PromptEngineer
 from bot.conversation import ConversationManager
 from bot.smart import MistralAPI
 
 debug_is_possible = False
 DEBUG = cfg['debug']
-bot = Bot(token=cfg['bot_token'], parse_mode='HTML')
-storage = MemoryStorage()
 mistral_api = MistralAPI(cfg['mistral_token'], cfg['mistral_model'])
 
-dp = Dispatcher(bot, storage=storage)
-
 logging.basicConfig(level=logging.DEBUG, 
                     handlers=[
                         logging.StreamHandler(),
@@ -28,8 +27,7 @@ log = logging.getLogger(__name__)
 
 doUpdateQuestions = False
 
-@dp.message_handler(commands="debug")
-async def handle_start_command(message: types.Message):
+async def handle_debug_command(message: types.Message):
     global DEBUG
     if debug_is_possible:
         DEBUG = not DEBUG
@@ -43,7 +41,6 @@ async def handle_start_command(message: types.Message):
 class ConversationStates(StatesGroup):
     in_conversation = State()
 
-@dp.message_handler(commands="start")
 async def handle_start_command(message: types.Message):
     await message.reply(
         "Follow Up Bot.\n\n"
@@ -66,7 +63,6 @@ async def reply_analysis(message, conversation):
     else:
         await message.reply("Анализ ответов недоступен.")
 
-@dp.message_handler(commands=['restart'])
 async def restart_conversation(message: types.Message, state: FSMContext):
     await ConversationStates.in_conversation.set()
     conversation = ConversationManager()
@@ -79,7 +75,6 @@ async def restart_conversation(message: types.Message, state: FSMContext):
     data.update(conversation=conversation)
     await state.update_data(data)
 
-@dp.message_handler(state=ConversationStates.in_conversation, content_types=types.ContentTypes.TEXT)
 async def handle_in_conversation(message: types.Message, state: FSMContext):
     if message.text == "/status":
         await check_status(message, state)
@@ -102,7 +97,6 @@ async def handle_in_conversation(message: types.Message, state: FSMContext):
     data.update(conversation=conversation)
     await state.update_data(data)
 
-@dp.message_handler(commands=['status'], state=ConversationStates.in_conversation)
 async def check_status(message: types.Message, state: FSMContext):
     data = await state.get_data()
     if "conversation" not in data:
@@ -116,6 +110,7 @@ async def check_status(message: types.Message, state: FSMContext):
     status += f"Закончен ли разговор: {conversation.is_concluded}\n"
     status += f"Есть ли вопросы: {conversation.have_questions}\n"
     status += f"Тип текущего batch (if_yes): {conversation.if_yes}\n"
+    status += f"Потрачено токенов: {await conversation.get_tokens_used()}\n"
     messages = await conversation.get_messages()
     messages = "\n".join(messages)
     log.info(f"Messages: {messages}")
@@ -123,7 +118,6 @@ async def check_status(message: types.Message, state: FSMContext):
     return
 
 
-@dp.message_handler(content_types=types.ContentTypes.TEXT)
 async def handle_outside_conversation(message: types.Message, state: FSMContext):
     conversation = ConversationManager()
     await conversation.initialize(message.chat.id)
@@ -140,5 +134,48 @@ async def handle_outside_conversation(message: types.Message, state: FSMContext)
         await message.reply(answer)
         await state.update_data(conversation=conversation)
 
+class TenantMiddleware(BaseMiddleware):
+    '''Makes the tenant of the dispatcher current while its updates are processed, so that Database and PromptEngineer use its shards and questionnaire.'''
+    def __init__(self, tenant: Tenant):
+        super().__init__()
+        self.tenant = tenant
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        current_tenant.set(self.tenant)
+
+def create_dispatcher(tenant: Tenant) -> Dispatcher:
+    bot = Bot(token=tenant.bot_token, parse_mode='HTML')
+    dp = Dispatcher(bot, storage=MemoryStorage())
+    dp.middleware.setup(TenantMiddleware(tenant))
+    dp.register_message_handler(handle_debug_command, commands="debug")
+    dp.register_message_handler(handle_start_command, commands="start")
+    dp.register_message_handler(restart_conversation, commands=['restart'])
+    dp.register_message_handler(handle_in_conversation, state=ConversationStates.in_conversation, content_types=types.ContentTypes.TEXT)
+    dp.register_message_handler(check_status, commands=['status'], state=ConversationStates.in_conversation)
+    dp.register_message_handler(handle_outside_conversation, content_types=types.ContentTypes.TEXT)
+    return dp
+
+async def main():
+    '''Polls the bots of all tenants on one event loop. Tenants without a bot_token are storage only, e.g. the replay tenant, and are not served.'''
+    tenants = [tenant for tenant in load_tenants() if tenant.bot_token]
+    if not tenants:
+        raise SystemExit("No tenant has a bot_token, nothing to serve")
+    dispatchers = [create_dispatcher(tenant) for tenant in tenants]
+    log.info(f"Serving tenants: {tenants}")
+    try:
+        for tenant in tenants:
+            for shard in range(len(tenant.shards)):
+                async with Database(shard=shard, tenant=tenant) as db:
+                    await db.init_schema() # Brings databases created by older versions up to date
+        for dp in dispatchers:
+            await dp.skip_updates()
+        await asyncio.gather(*(dp.start_polling() for dp in dispatchers))
+    finally:
+        for dp in dispatchers:
+            await dp.storage.close()
+            await dp.bot.session.close()
+        for tenant in tenants:
+            await tenant.close()
+
 if __name__ == "__main__":
-    executor.start_polling(dp, skip_updates=True)
+    asyncio.run(main())
@@ -3,7 +3,7 @@ from utils.database import Database
 from bot.questionnaire import parse_json_to_questions
 import logging
 log = logging.getLogger(__name__)
-import time
+import asyncio
 
 def construct_questions(questions):
     '''Parses the questions json into a nested list.'''
@@ -36,19 +36,21 @@ async def analyze_answers(chat_id: int, llm):
     questions = []
     for stage_id in range(1, max_stage_id + 1):
         # Each stage is processed independently
-        async with Database() as db:
+        async with Database(chat_id) as db:
             messages = await db.get_stage_messages(chat_id, stage_id - 1)
         stage_questions = stages[stage_id - 1]['questions']
         stage_questions = parse_json_to_questions(stage_questions)
         stage_questions = construct_questions(stage_questions)
         questions.extend(stage_questions)
         messages.append({'role': 'user', 'content': PromptEngineer.prompt_answers_list(stage_questions)})
-        answer = llm.generate(messages)
+        answer, usage = await asyncio.to_thread(llm.generate_with_usage, messages)
+        async with Database(chat_id) as db:
+            await db.add_token_usage(chat_id, stage_id - 1, "analysis", usage)
         log.info(f"Answers analysis for stage {stage_id}: {answer}")
         analysis.append(answer)
-        time.sleep(3) # To avoid rate limiting
+        await asyncio.sleep(llm.cooldown) # To avoid rate limiting
     analysis = "\n".join(analysis)
-    async with Database() as db:
+    async with Database(chat_id) as db:
         await db.insert_answers(chat_id, questions, parse_answers(analysis))
     return analysis
 
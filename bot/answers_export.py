@@ -0,0 +1,147 @@
+import csv
+import json
+import logging
+from datetime import timedelta
+from typing import Optional
+
+from bot.prompt_engineer import PromptEngineer
+from bot.questionnaire import parse_json_to_questions
+from bot.answers_analyzer import construct_questions
+from utils.database import Database
+from utils.tenants import get_tenant
+
+log = logging.getLogger(__name__)
+
+FORMATS = ("csv", "jsonl", "parquet")
+EXPORT_LAG = timedelta(minutes=5) # answers younger than this may still be uncommitted and are left for the next export
+
+def get_question_ids():
+    '''Returns ids of all questions from the questionnaire, in questionnaire order.'''
+    question_ids = []
+    for stage in PromptEngineer.load_stages():
+        questions = construct_questions(parse_json_to_questions(stage['questions']))
+        question_ids.extend(question['id'] for question in questions)
+    return question_ids
+
+async def pivot_answers(records, question_ids):
+    '''Groups the answer records into one row per patient submission: {'chat_id': ..., 'answered_at': ..., question_id: answer_text, ...}.
+    Expects records ordered by answered_at and chat_id, so that only one row is kept in memory.
+    Answers written before the answered_at migration share one timestamp, so several submissions of a chat may fall into one row;
+    of repeated answers to a question only the first is kept.'''
+    known_ids = set(question_ids)
+    row = None
+    answered = set()
+    async for record in records:
+        key = (record['chat_id'], record['answered_at'])
+        if row is None or (row['chat_id'], row['answered_at']) != key:
+            if row is not None:
+                yield row
+            row = {'chat_id': record['chat_id'], 'answered_at': record['answered_at']}
+            row.update((question_id, None) for question_id in question_ids)
+            answered = set()
+        if record['question_id'] in answered:
+            log.warning(f"Chat {record['chat_id']} has several answers to question {record['question_id']} at {record['answered_at']}, keeping the first")
+        elif record['question_id'] in known_ids:
+            answered.add(record['question_id'])
+            row[record['question_id']] = record['answer_text']
+        else:
+            log.warning(f"Question {record['question_id']} is not in the questionnaire, skipping")
+    if row is not None:
+        yield row
+
+class CsvWriter:
+    def __init__(self, file, question_ids):
+        self.writer = csv.writer(file)
+        self.question_ids = question_ids
+        self.writer.writerow(['chat_id', 'answered_at'] + [str(question_id) for question_id in question_ids])
+
+    def write(self, row):
+        self.writer.writerow([row['chat_id'], row['answered_at'].isoformat()] + [row[question_id] for question_id in self.question_ids])
+
+    def close(self):
+        pass
+
+class JsonlWriter:
+    def __init__(self, file, question_ids):
+        self.file = file
+        self.question_ids = question_ids
+
+    def write(self, row):
+        entry = {'chat_id': row['chat_id'], 'answered_at': row['answered_at'].isoformat()}
+        entry.update((str(question_id), row[question_id]) for question_id in self.question_ids)
+        self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def close(self):
+        pass
+
+class ParquetWriter:
+    '''Writes rows to parquet in row groups of batch_size rows. Requires pyarrow.'''
+    def __init__(self, file, question_ids, batch_size=10000):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Parquet export requires pyarrow, install it with `pip install pyarrow`")
+        self.pa = pa
+        self.question_ids = question_ids
+        self.batch_size = batch_size
+        self.schema = pa.schema(
+            [('chat_id', pa.int64()), ('answered_at', pa.timestamp('us', tz='UTC'))]
+            + [(str(question_id), pa.string()) for question_id in question_ids]
+        )
+        self.writer = pq.ParquetWriter(file, self.schema)
+        self.batch = []
+
+    def write(self, row):
+        self.batch.append(row)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        data = {
+            'chat_id': [row['chat_id'] for row in self.batch],
+            'answered_at': [row['answered_at'] for row in self.batch],
+        }
+        for question_id in self.question_ids:
+            data[str(question_id)] = [row[question_id] for row in self.batch]
+        self.writer.write_table(self.pa.table(data, schema=self.schema))
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+async def export_answers(output_path: str, fmt: str = "csv", since: Optional[dict] = None, lag: timedelta = EXPORT_LAG) -> dict:
+    '''Streams answers written after since and at least lag ago into output_path, one row per patient with one column per question id.
+    Shards of the current tenant are exported one after another. since and the returned watermarks are per shard, {shard: answered_at},
+    because every shard stamps answered_at with its own clock. The result is to be used as since for the next incremental export.'''
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format {fmt}, expected one of {', '.join(FORMATS)}")
+    since = since or {}
+    question_ids = get_question_ids()
+    watermarks = {}
+    rows = 0
+    mode = 'wb' if fmt == 'parquet' else 'w'
+    with open(output_path, mode, **({} if fmt == 'parquet' else {'encoding': 'utf-8', 'newline': ''})) as file:
+        if fmt == 'csv':
+            writer = CsvWriter(file, question_ids)
+        elif fmt == 'jsonl':
+            writer = JsonlWriter(file, question_ids)
+        else:
+            writer = ParquetWriter(file, question_ids)
+        for shard in range(len(get_tenant().shards)):
+            async with Database(shard=shard) as db:
+                until = await db.get_export_bound(lag)
+                shard_since = since.get(shard)
+                if shard_since is not None and shard_since >= until:
+                    watermarks[shard] = shard_since
+                    continue
+                async for row in pivot_answers(db.iter_answers(shard_since, until), question_ids):
+                    writer.write(row)
+                    rows += 1
+            watermarks[shard] = until
+        writer.close()
+    log.info(f"Exported {rows} rows to {output_path}, watermarks {watermarks}")
+    return watermarks
@@ -3,9 +3,21 @@ from bot.questionnaire import StageOperator
 from bot.prompt_engineer import PromptEngineer
 from bot.answers_analyzer import analyze_answers
 from utils.config import cfg
+import asyncio
 import logging
 log = logging.getLogger(__name__)
 
+archive_tasks = set() # Keeps references to running archive tasks so they are not garbage collected
+
+async def archive_chatlogs(chat_id, up_to):
+    '''Moves the messages of a restarted conversation out of the hot chatlogs table.'''
+    try:
+        async with Database(chat_id) as db:
+            archived = await db.archive_chatlogs(chat_id, up_to)
+        log.debug(f"Archived {archived} messages of chat {chat_id}")
+    except Exception:
+        log.exception(f"Failed to archive messages of chat {chat_id}, leaving them for the retention job")
+
 class ConversationManager:
     '''Convesation has parts:
     - is_started: whether bot sent the initial message
@@ -34,14 +46,14 @@ class ConversationManager:
 
     async def load(self, chat_id):
         '''Reload the conversation from the database'''
-        async with Database() as db:
-            self.chat_id = chat_id
+        self.chat_id = chat_id
+        async with Database(chat_id) as db:
             self.have_questions = False
             self.stage_id, self.batch_id, self.is_started, self.is_concluded, self.set_theme = await db.get_conv_stage(chat_id)
             self.load_stage()
 
     async def add_message(self, message, role):
-       async with Database() as db:
+       async with Database(self.chat_id) as db:
            await db.add_message(self.chat_id, message, role, self.stage_id)
 
     def load_stage(self, stage_id=None, batch_id=None):
@@ -74,34 +86,52 @@ class ConversationManager:
     async def end_convesation(self, llm):
         self.is_concluded = True
         self.analysis = await analyze_answers(self.chat_id, llm)
-        async with Database() as db:
+        async with Database(self.chat_id) as db:
             await db.end_conv(self.chat_id)
 
     async def restart_conversation(self):
         self.is_concluded = False
         self.is_started = False
-        async with Database() as db:
-            await db.restart_conv(self.chat_id)
+        async with Database(self.chat_id) as db:
+            log_offset = await db.restart_conv(self.chat_id)
+        if log_offset > 0:
+            task = asyncio.create_task(archive_chatlogs(self.chat_id, log_offset))
+            archive_tasks.add(task)
+            task.add_done_callback(archive_tasks.discard)
         await self.load(self.chat_id)
 
     async def get_chatbot_answer(self, llm):
-        async with Database() as db:
+        '''Gets the next LLM reply and records its token usage. Once the conversation exceeds the token budget,
+        the context is compressed and the cheaper budget model is used.'''
+        async with Database(self.chat_id) as db:
             messages = await db.get_messages(self.chat_id)
-        answer = llm.generate(messages)
+            tokens_used = await db.get_tokens_used(self.chat_id)
+        model = None
+        if cfg['token_budget'] and tokens_used >= cfg['token_budget']:
+            log.debug(f"Token budget exceeded: {tokens_used} >= {cfg['token_budget']}")
+            messages = PromptEngineer.compress_messages(messages, cfg['budget_context'])
+            model = cfg['budget_model']
+        answer, usage = await asyncio.to_thread(llm.generate_with_usage, messages, model) # Keeps the event loop shared by tenants responsive
+        async with Database(self.chat_id) as db:
+            await db.add_token_usage(self.chat_id, self.stage_id, "conversation", usage)
         log.info(f"LLM Answer: {answer}")
         return answer
     
     async def get_messages(self):
         '''Returns messages in the format ["role: message", ...] as a list of strings. Used only for debug/logging.'''
-        async with Database() as db:
+        async with Database(self.chat_id) as db:
             messages = await db.get_messages(self.chat_id)
         message_logs = []
         for message in messages:
             message_logs.append(f"{message['role']}: {message['content']}")
         return message_logs
     
+    async def get_tokens_used(self):
+        async with Database(self.chat_id) as db:
+            return await db.get_tokens_used(self.chat_id)
+
     async def update_db(self):
-        async with Database() as db:
+        async with Database(self.chat_id) as db:
             self.batch_id = self.questionnaire.get_current_batch_id()
             await db.set_conv_stage(self.chat_id, self.stage_id, self.batch_id, self.is_started, self.is_concluded, self.set_theme)
 
@@ -122,7 +152,7 @@ class ConversationManager:
             log.debug("Starting a conversation")
             self.is_started = True
             self.have_questions = False
-            async with Database() as db:
+            async with Database(self.chat_id) as db:
                 await db.start_conv(self.chat_id)
                 initial_system = PromptEngineer.initial_system_prompt()
                 await db.add_message(self.chat_id, initial_system, "system", self.stage_id)
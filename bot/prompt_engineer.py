@@ -1,10 +1,11 @@
 import logging
 import json
+from utils.tenants import get_tenant
 
 log = logging.getLogger(__name__)
 
 class PromptEngineer:
-    stages_ = None
+    stages_ = {} # stages per questionnaire file
 
     @staticmethod
     def get_questions_text(questions):
@@ -32,10 +33,12 @@ class PromptEngineer:
     
     @staticmethod
     def load_stages():
-        if PromptEngineer.stages_ is None:
-            with open('test_stages.json', 'r', encoding='utf-8') as file: # change to stages.json for production
-                PromptEngineer.stages_ = json.load(file)["stages"]
-        return PromptEngineer.stages_
+        '''Returns the questionnaire stages of the current tenant'''
+        stages_file = get_tenant().stages_file
+        if stages_file not in PromptEngineer.stages_:
+            with open(stages_file, 'r', encoding='utf-8') as file:
+                PromptEngineer.stages_[stages_file] = json.load(file)["stages"]
+        return PromptEngineer.stages_[stages_file]
     
     @staticmethod
     def get_stage(stage_id):
@@ -56,6 +59,36 @@ class PromptEngineer:
     def initial_system_prompt():
         return "Это звонок с пациентом. Ты - врач, который должен провести разговор с пациентом с целью получения ответов на вопросы из опросника. Задавай вопросы ТОЛЬКО по одному, не нагружай пациента, НИКОГДА НЕ ПЕРЕЧИСЛЯЙ ВОПРОСЫ, это обычный разговор, в разговоре люди отвечают на вопросы по одному, будь вежлив и будь готов переспросить, если пациент не смог ответить. Веди нормальный, человечный, неструктурированный телефонный разговор, никаких дополнительных реплик, только вопросы! Пиши только сам вопрос, как это бы прозвучало в нормальном диалоге. Сами вопросы -- это темы для разговора, не сухие вопросы, перефразируй их как человеческий вопрос от доктора к пациенту. Пиши только от лица врача, никогда не пиши от лица пациента, юзер - пациент. Реплики пациента будут выглядеть \"Пациент: \"*текст того, что сказал пациент*\"\", а твои реплики будут выглядеть \"*текст того, что ты сказал*\". Помимо реплик пациента тебе будет передана информация о вопросах, её видишь только ты, ты отвечаешь только на реплики пациента."
     
+    @staticmethod
+    def initial_system_prompt_short():
+        return "Ты - врач, разговор с пациентом (юзер) для заполнения опросника. Задавай вопросы по одному, человеческим языком, перефразируя их. Пиши только реплики врача. Реплики пациента выглядят \"Пациент: \"*текст*\"\". Информацию о вопросах видишь только ты."
+
+    @staticmethod
+    def is_questions_prompt(message):
+        return message['role'] == 'user' and message['content'].startswith("Текущая тема:")
+
+    @staticmethod
+    def is_if_question_prompt(message):
+        return PromptEngineer.is_questions_prompt(message) and "\\yes" in message['content']
+
+    @staticmethod
+    def is_answers_list_prompt(message):
+        return message['role'] == 'user' and message['content'].startswith("Запиши ответы пациента")
+
+    @staticmethod
+    def compress_messages(messages, context_size):
+        '''Shrinks the context for conversations over the token budget: replaces the initial system prompt with a short one
+        and keeps only the last context_size messages, plus the latest questions prompt if it falls out of them.'''
+        if not messages:
+            return messages
+        system = {'role': 'system', 'content': PromptEngineer.initial_system_prompt_short()}
+        history = messages[1:] if messages[0]['role'] == 'system' else messages
+        tail = history[-context_size:] if context_size > 0 else []
+        questions = [m for m in history if PromptEngineer.is_questions_prompt(m)]
+        if questions and questions[-1] not in tail:
+            tail = [questions[-1]] + tail
+        return [system] + tail
+
     @staticmethod
     def initial_theme_prompt():
         return "Как вы себя сейчас чувствуете? Есть жалобы?"
@@ -63,7 +96,7 @@ class PromptEngineer:
     @staticmethod
     def construct_questions_prompt(questions, stage_name):
         questions = "\n".join(questions)
-        prompt = f"Текущая тема: {stage_name}"
+        prompt = f"Текущая тема: {stage_name}" # is_questions_prompt relies on this prefix
         prompt += f"\n\nВопросы, на которые нужно сейчас получить ответы от пациента:\n{questions}"
         prompt += "\n\nКогда получишь ответы на эти вопросы от пациента, напиши \"\\done\", чтобы продолжить к следующей теме или следующим вопросам."
         return prompt
@@ -79,5 +112,5 @@ class PromptEngineer:
     @staticmethod
     def prompt_answers_list(questions):
         questions_str = "\n".join([f"{q['id']}: {q['text']}" for q in questions])
-        prompt = f"Запиши ответы пациента на следующие вопросы в формате \"id: ответ\", если пациент не дал ответа, напиши None. Вопросы: \n{questions_str}"
+        prompt = f"Запиши ответы пациента на следующие вопросы в формате \"id: ответ\", если пациент не дал ответа, напиши None. Вопросы: \n{questions_str}" # is_answers_list_prompt relies on this prefix
         return prompt
\ No newline at end of file
@@ -0,0 +1,330 @@
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import statistics
+from concurrent.futures import ProcessPoolExecutor
+
+from bot.conversation import ConversationManager, archive_tasks
+from bot.answers_analyzer import parse_answers
+from bot.prompt_engineer import PromptEngineer
+from bot.smart import MistralAPI
+from utils.config import cfg
+from utils.database import REPLAY_CHAT_ID_BASE, Database
+from utils.tenants import current_tenant, find_tenant, get_tenant
+
+log = logging.getLogger(__name__)
+
+def estimate_tokens(text: str) -> int:
+    '''Rough token count for backends that do not report usage'''
+    return max(1, len(text) // 3)
+
+def unwrap_patient_message(text: str) -> str:
+    '''Strips the "Пациент: "..."" wrapping added by ConversationManager'''
+    prefix = 'Пациент: "'
+    if text.startswith(prefix) and text.endswith('"'):
+        return text[len(prefix):-1]
+    return text
+
+class StubLLM:
+    '''Deterministic offline LLM for replays. Asks the first question of every batch, answers if-questions with \\yes when the patient
+    reply starts with "да" and \\no otherwise, marks other batches \\done after one patient reply, and extracts as the answer to each
+    question the first patient reply given after that question was asked.'''
+    cooldown = 0
+
+    def start_turn(self, turn: int):
+        pass
+
+    def generate(self, messages: list[str]) -> str:
+        return self.generate_with_usage(messages)[0]
+
+    def generate_with_usage(self, messages: list[str], model: str = None) -> tuple[str, dict]:
+        answer = self.reply(messages)
+        usage = {
+            "model": model or "stub",
+            "prompt_tokens": sum(estimate_tokens(message['content']) for message in messages),
+            "completion_tokens": estimate_tokens(answer),
+        }
+        return answer, usage
+
+    def reply(self, messages):
+        last = messages[-1]
+        if PromptEngineer.is_answers_list_prompt(last):
+            return self.answers_list(messages)
+        if PromptEngineer.is_questions_prompt(last):
+            return self.questions(last)[0]
+        prompts = [message for message in messages if PromptEngineer.is_questions_prompt(message)]
+        if last['role'] == 'user' and prompts:
+            if PromptEngineer.is_if_question_prompt(prompts[-1]):
+                said_yes = unwrap_patient_message(last['content']).strip().lower().startswith("да")
+                return "\\yes" if said_yes else "\\no"
+            return "Спасибо. \\done"
+        return "Расскажите подробнее, пожалуйста."
+
+    @staticmethod
+    def questions(prompt):
+        '''Returns the question lines of a questions prompt'''
+        sections = prompt['content'].split("\n\n")
+        return sections[1].split("\n")[1:] if len(sections) > 1 else [prompt['content']]
+
+    def answers_list(self, messages):
+        questions = messages[-1]['content'].split("Вопросы: \n", 1)[-1].split("\n")
+        lines = []
+        for question in questions:
+            question_id, _, text = question.partition(": ")
+            answer = None
+            asked = False
+            for message in messages[:-1]:
+                if PromptEngineer.is_questions_prompt(message) and text in self.questions(message):
+                    asked = True
+                elif asked and message['role'] == 'user' and not PromptEngineer.is_questions_prompt(message):
+                    answer = unwrap_patient_message(message['content'])
+                    break
+            lines.append(f"{question_id}: {answer}")
+        return "\n".join(lines)
+
+class CassetteLLM:
+    '''Replays responses recorded in a json cassette. Responses are keyed by their position in the script, "turn:call" with the call
+    counted within the turn, so that a cassette keeps replaying after prompt or batching changes alter the requests. In strict mode
+    a response is only replayed for the exact request it was recorded for. If backend is given, missing responses (and, in strict mode,
+    responses to changed requests) are requested from it and recorded; call save to write the cassette.'''
+    def __init__(self, path: str, backend=None, strict: bool = False):
+        self.path = path
+        self.backend = backend
+        self.strict = strict
+        self.cooldown = backend.cooldown if backend is not None else 0
+        self.turn = 0
+        self.call = 0
+        self.responses = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as file:
+                self.responses = json.load(file)
+
+    @staticmethod
+    def request_hash(messages, model):
+        return hashlib.sha256(json.dumps([model, messages], ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def start_turn(self, turn: int):
+        self.turn = turn
+        self.call = 0
+
+    def generate(self, messages: list[str]) -> str:
+        return self.generate_with_usage(messages)[0]
+
+    def generate_with_usage(self, messages: list[str], model: str = None) -> tuple[str, dict]:
+        key = f"{self.turn}:{self.call}"
+        self.call += 1
+        request = CassetteLLM.request_hash(messages, model)
+        entry = self.responses.get(key)
+        if entry is None or (self.strict and entry["request"] != request):
+            if self.backend is None:
+                raise KeyError(f"No recorded response for call {key} in cassette {self.path}")
+            answer, usage = self.backend.generate_with_usage(messages, model)
+            entry = self.responses[key] = {"request": request, "content": answer, "usage": usage}
+        usage = entry["usage"]
+        if entry["request"] != request:
+            # The recorded prompt size is stale after a prompt change, so it is estimated from the new request
+            usage = dict(usage, prompt_tokens=sum(estimate_tokens(message['content']) for message in messages))
+        return entry["content"], usage
+
+    def save(self):
+        with open(self.path, 'w', encoding='utf-8') as file:
+            json.dump(self.responses, file, ensure_ascii=False, indent=1)
+
+class RecordingLLM:
+    '''Wraps an LLM backend and records every call with the turn and stage it was made in.'''
+    def __init__(self, llm, conversation):
+        self.llm = llm
+        self.conversation = conversation
+        self.cooldown = llm.cooldown
+        self.turn = 0
+        self.calls = []
+
+    def start_turn(self, turn: int):
+        self.turn = turn
+        self.llm.start_turn(turn)
+
+    def generate(self, messages: list[str]) -> str:
+        return self.generate_with_usage(messages)[0]
+
+    def generate_with_usage(self, messages: list[str], model: str = None) -> tuple[str, dict]:
+        answer, usage = self.llm.generate_with_usage(messages, model)
+        self.calls.append({
+            "turn": self.turn,
+            "stage_id": self.conversation.stage_id,
+            "kind": "analysis" if PromptEngineer.is_answers_list_prompt(messages[-1]) else "conversation",
+            "prompt_tokens": usage["prompt_tokens"],
+            "completion_tokens": usage["completion_tokens"],
+        })
+        return answer, usage
+
+def load_scripts(paths):
+    '''Loads patient scripts from json files or directories of them. A script is {"name": ..., "messages": ["patient reply", ...], "answers": {"question_id": "expected answer", ...}},
+    a file holds one script or a list of them.'''
+    scripts = []
+    for path in paths:
+        files = [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.json')] if os.path.isdir(path) else [path]
+        for file_path in files:
+            with open(file_path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+            for i, script in enumerate(data if isinstance(data, list) else [data]):
+                script.setdefault("name", f"{os.path.basename(file_path)}:{i}")
+                script.setdefault("answers", {})
+                scripts.append(script)
+    return scripts
+
+def pick_completed_transcript(transcripts: list[list[dict]], submissions: list[tuple]):
+    '''Pairs conversations with the answer submissions written while they were the latest conversation of the chat,
+    and returns the last conversation that has answers together with its last submission, or (None, None).'''
+    for i in reversed(range(len(transcripts))):
+        if not transcripts[i]:
+            continue
+        started_at = transcripts[i][0]['created_at']
+        next_started_at = transcripts[i + 1][0]['created_at'] if i + 1 < len(transcripts) and transcripts[i + 1] else None
+        answers = [
+            answers for answered_at, answers in submissions
+            if answered_at >= started_at and (next_started_at is None or answered_at < next_started_at)
+        ]
+        if answers:
+            return transcripts[i], answers[-1]
+    return None, None
+
+async def script_from_chatlogs(chat_id: int) -> dict:
+    '''Builds a script from the last completed conversation of chat_id, live or archived: its patient replies, with the answers
+    extracted from that conversation as expected answers.'''
+    async with Database(chat_id) as db:
+        transcripts = await db.get_transcripts(chat_id)
+        submissions = await db.get_answer_submissions(chat_id)
+    transcript, answers = pick_completed_transcript(transcripts, submissions)
+    if transcript is None:
+        log.warning(f"Chat {chat_id} has no completed conversation, replaying its last one without expected answers")
+        transcript, answers = (transcripts[-1] if transcripts else []), {}
+    patient_messages = [
+        unwrap_patient_message(message['content']) for message in transcript
+        if message['role'] == 'user' and message['content'].startswith('Пациент: ')
+    ]
+    return {
+        "name": f"chat_{chat_id}",
+        "messages": patient_messages,
+        "answers": {str(question_id): answer for question_id, answer in answers.items() if answer is not None},
+    }
+
+def is_answer_correct(expected, extracted):
+    if extracted is None:
+        return False
+    expected = expected.strip().casefold()
+    extracted = extracted.strip().casefold()
+    return expected == extracted or expected in extracted
+
+async def replay_script(script: dict, llm, chat_id: int) -> dict:
+    '''Runs the patient replies of the script through ConversationManager and returns the replay metrics.'''
+    conversation = ConversationManager()
+    await conversation.initialize(chat_id)
+    recorder = RecordingLLM(llm, conversation)
+    await conversation.restart_conversation()
+    await conversation.get_response(None, recorder)
+    turns = 0
+    yes_no_tag_failures = 0
+    turns_without_done = 0
+    completed = False
+    for message in script["messages"]:
+        turns += 1
+        recorder.start_turn(turns)
+        waiting_for_tag = conversation.if_yes
+        in_batch = conversation.have_questions
+        position = (conversation.stage_id, conversation.questionnaire.get_current_batch_id())
+        answer = await conversation.get_response(message, recorder)
+        if answer is None:
+            completed = True
+            break
+        if in_batch and position == (conversation.stage_id, conversation.questionnaire.get_current_batch_id()):
+            # An if-question batch must advance on every reply. A regular batch may legitimately take a follow-up question,
+            # so turns it stays on are only counted, as an upper bound of missed \done tags.
+            if waiting_for_tag:
+                yes_no_tag_failures += 1
+            else:
+                turns_without_done += 1
+    await asyncio.gather(*archive_tasks)
+
+    calls_per_stage = {}
+    for call in recorder.calls:
+        if call["kind"] == "conversation":
+            calls_per_stage[call["stage_id"]] = calls_per_stage.get(call["stage_id"], 0) + 1
+    prompt_tokens_per_turn = {}
+    for call in recorder.calls:
+        if call["kind"] == "conversation" and call["turn"] > 0:
+            prompt_tokens_per_turn[call["turn"]] = prompt_tokens_per_turn.get(call["turn"], 0) + call["prompt_tokens"]
+
+    correct = 0
+    if completed and conversation.analysis and script["answers"]:
+        extracted = parse_answers(conversation.analysis)
+        correct = sum(is_answer_correct(expected, extracted.get(int(question_id))) for question_id, expected in script["answers"].items())
+    return {
+        "name": script["name"],
+        "completed": completed,
+        "turns": turns,
+        "llm_calls_per_stage": calls_per_stage,
+        "analysis_calls": sum(call["kind"] == "analysis" for call in recorder.calls),
+        "prompt_tokens_per_turn": [prompt_tokens_per_turn.get(turn, 0) for turn in range(1, turns + 1)],
+        "yes_no_tag_failures": yes_no_tag_failures,
+        "turns_without_done": turns_without_done,
+        "expected_answers": len(script["answers"]),
+        "correct_answers": correct,
+    }
+
+def create_llm(backend: str, cassette_dir: str, record: bool, strict: bool, script_name: str):
+    if backend == "stub":
+        return StubLLM()
+    path = os.path.join(cassette_dir, f"{script_name.replace(os.sep, '_')}.json")
+    return CassetteLLM(path, MistralAPI(cfg['mistral_token'], cfg['mistral_model']) if record else None, strict)
+
+def run_replay(script: dict, index: int, backend: str, cassette_dir: str, record: bool, strict: bool, tenant_name: str) -> dict:
+    '''Replays one script in its own event loop. Runs in a worker process.'''
+    async def run():
+        if tenant_name:
+            current_tenant.set(find_tenant(tenant_name))
+        llm = create_llm(backend, cassette_dir, record, strict, script["name"])
+        try:
+            return await replay_script(script, llm, REPLAY_CHAT_ID_BASE - index)
+        except Exception as e:
+            log.exception(f"Replay of {script['name']} failed")
+            return {"name": script["name"], "error": repr(e)}
+        finally:
+            if isinstance(llm, CassetteLLM) and record:
+                llm.save()
+            await get_tenant().close()
+    return asyncio.run(run())
+
+def replay_all(scripts: list[dict], backend: str = "stub", cassette_dir: str = None, record: bool = False, strict: bool = False, tenant_name: str = None, processes: int = None) -> list[dict]:
+    '''Replays the scripts in parallel worker processes and returns their metrics in script order.'''
+    # spawn, so that workers do not inherit connection pools of the parent process
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [
+            executor.submit(run_replay, script, index, backend, cassette_dir, record, strict, tenant_name)
+            for index, script in enumerate(scripts)
+        ]
+        return [future.result() for future in futures]
+
+def summarize(results: list[dict]) -> dict:
+    '''Aggregates per-script replay metrics'''
+    replayed = [result for result in results if "error" not in result]
+    completed = [result for result in replayed if result["completed"]]
+    calls_per_stage = {}
+    for result in replayed:
+        for stage_id, calls in result["llm_calls_per_stage"].items():
+            calls_per_stage.setdefault(stage_id, []).append(calls)
+    prompt_tokens = [tokens for result in replayed for tokens in result["prompt_tokens_per_turn"]]
+    expected = sum(result["expected_answers"] for result in completed)
+    return {
+        "scripts": len(results),
+        "errors": len(results) - len(replayed),
+        "completed": len(completed),
+        "mean_turns_to_completion": statistics.mean(result["turns"] for result in completed) if completed else None,
+        "mean_llm_calls_per_stage": {stage_id: statistics.mean(calls) for stage_id, calls in sorted(calls_per_stage.items())},
+        "mean_prompt_tokens_per_turn": statistics.mean(prompt_tokens) if prompt_tokens else None,
+        "yes_no_tag_failures": sum(result["yes_no_tag_failures"] for result in replayed),
+        "turns_without_done": sum(result["turns_without_done"] for result in replayed),
+        "answer_accuracy": sum(result["correct_answers"] for result in completed) / expected if expected else None,
+    }
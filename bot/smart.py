@@ -3,17 +3,28 @@ from mistralai import Mistral
 
 class MistralAPI:
     '''LLM. Uses Mistral API. Generate expects format [{"role": "user", "content": "Hello, how are you?"}, ...]. System prompt may be only one and placed before every other message.'''
+    cooldown = 3 # seconds between answer analysis calls, to avoid rate limiting
+
     def __init__(self, token: str, model: str = "mistral-large-latest"):
         self.api = Mistral(api_key=token)
         self.model = model
     
     def generate(self, messages: list[str]) -> str:
+        return self.generate_with_usage(messages)[0]
+
+    def generate_with_usage(self, messages: list[str], model: str = None) -> tuple[str, dict]:
+        '''Same as generate, but also returns the token usage of the call in the format {"model": ..., "prompt_tokens": ..., "completion_tokens": ...}. Model defaults to the one given in the constructor.'''
+        model = model or self.model
         chat_response = self.api.chat.complete(
-            model=self.model, messages=messages
+            model=model, messages=messages
         )
-        return chat_response.choices[0].message.content
+        usage = {
+            "model": model,
+            "prompt_tokens": chat_response.usage.prompt_tokens,
+            "completion_tokens": chat_response.usage.completion_tokens,
+        }
+        return chat_response.choices[0].message.content, usage
 
     def generate_stream(self, messages: list[str]):
         for chunk in self.api.chat.complete_stream( model=self.model, messages=messages ):
             yield chunk.choices[0].delta.content
-
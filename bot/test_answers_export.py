@@ -0,0 +1,58 @@
+import asyncio
+import io
+import json
+from datetime import datetime, timezone
+
+from bot.answers_export import CsvWriter, JsonlWriter, get_question_ids, pivot_answers
+
+T1 = datetime(2024, 1, 1, tzinfo=timezone.utc)
+T2 = datetime(2024, 1, 2, tzinfo=timezone.utc)
+
+async def records(rows):
+    for chat_id, question_id, answer_text, answered_at in rows:
+        yield {'chat_id': chat_id, 'question_id': question_id, 'answer_text': answer_text, 'answered_at': answered_at}
+
+async def collect(generator):
+    return [row async for row in generator]
+
+def pivot(rows, question_ids):
+    return asyncio.run(collect(pivot_answers(records(rows), question_ids)))
+
+def test_pivot_one_row_per_submission():
+    rows = pivot([
+        (1, 1, "Хорошо", T1), (1, 2, None, T1),
+        (2, 1, "Плохо", T1),
+        (1, 1, "Лучше", T2),
+    ], [1, 2])
+    assert rows == [
+        {'chat_id': 1, 'answered_at': T1, 1: "Хорошо", 2: None},
+        {'chat_id': 2, 'answered_at': T1, 1: "Плохо", 2: None},
+        {'chat_id': 1, 'answered_at': T2, 1: "Лучше", 2: None},
+    ]
+
+def test_pivot_skips_unknown_questions():
+    assert pivot([(1, 1, "Да", T1), (1, 99, "?", T1)], [1]) == [{'chat_id': 1, 'answered_at': T1, 1: "Да"}]
+
+def test_pivot_keeps_first_of_repeated_answers():
+    # submissions written before the answered_at migration share one timestamp
+    assert pivot([(1, 1, "Первый", T1), (1, 1, "Второй", T1)], [1]) == [{'chat_id': 1, 'answered_at': T1, 1: "Первый"}]
+
+def test_pivot_empty():
+    assert pivot([], [1, 2]) == []
+
+def test_question_ids_follow_questionnaire():
+    assert get_question_ids() == list(range(1, 11))
+
+def test_csv_writer():
+    file = io.StringIO()
+    writer = CsvWriter(file, [1, 2])
+    writer.write({'chat_id': 5, 'answered_at': T1, 1: "Да", 2: None})
+    writer.close()
+    assert file.getvalue().splitlines() == ["chat_id,answered_at,1,2", "5,2024-01-01T00:00:00+00:00,Да,"]
+
+def test_jsonl_writer():
+    file = io.StringIO()
+    writer = JsonlWriter(file, [1, 2])
+    writer.write({'chat_id': 5, 'answered_at': T1, 1: "Да", 2: None})
+    writer.close()
+    assert json.loads(file.getvalue()) == {'chat_id': 5, 'answered_at': "2024-01-01T00:00:00+00:00", '1': "Да", '2': None}
@@ -0,0 +1,61 @@
+import asyncio
+
+from bot.conversation import ConversationManager, archive_tasks
+
+def test_restart_hides_old_messages_and_archives_them(fake_db):
+    async def scenario():
+        conversation = ConversationManager()
+        await conversation.initialize(1)
+        await conversation.add_message("old question", "assistant")
+        await conversation.add_message("old answer", "user")
+        await conversation.restart_conversation()
+        hidden = await conversation.get_messages()
+        await asyncio.gather(*archive_tasks)
+        await conversation.add_message("new question", "assistant")
+        return hidden, await conversation.get_messages()
+
+    hidden, messages = asyncio.run(scenario())
+    assert hidden == []
+    assert messages == ["assistant: new question"]
+    assert [m['message_text'] for m in fake_db['archive'][0]['messages']] == ["old question", "old answer"]
+    assert [m['message_id'] for m in fake_db['chatlogs']] == [3]
+
+def test_restart_of_empty_chat_archives_nothing(fake_db):
+    async def scenario():
+        conversation = ConversationManager()
+        await conversation.initialize(2)
+        await conversation.restart_conversation()
+        await asyncio.gather(*archive_tasks)
+
+    asyncio.run(scenario())
+    assert fake_db['archive'] == []
+
+class ModelRecorder:
+    cooldown = 0
+
+    def __init__(self):
+        self.requests = []
+
+    def generate_with_usage(self, messages, model=None):
+        self.requests.append((messages, model))
+        return "Ответ", {"model": model or "main", "prompt_tokens": 100, "completion_tokens": 10}
+
+def test_token_budget_switches_to_budget_model(fake_db, monkeypatch):
+    from bot import conversation as module
+    monkeypatch.setitem(module.cfg, 'token_budget', 150)
+    monkeypatch.setitem(module.cfg, 'budget_context', 1)
+
+    async def scenario():
+        conversation = ConversationManager()
+        await conversation.initialize(3)
+        llm = ModelRecorder()
+        for i in range(3):
+            await conversation.add_message(f"Пациент: \"{i}\"", "user")
+            await conversation.get_chatbot_answer(llm)
+        return llm
+
+    llm = asyncio.run(scenario())
+    assert [model for _, model in llm.requests] == [None, None, module.cfg['budget_model']]
+    assert len(llm.requests[2][0]) == 2 # short system prompt and the last message
+    assert fake_db['convs'][3]['tokens_used'] == 330
+    assert [usage['stage_id'] for usage in fake_db['token_usage']] == [0, 0, 0]
@@ -0,0 +1,42 @@
+from bot.prompt_engineer import PromptEngineer
+
+def conversation():
+    return [
+        {'role': 'system', 'content': PromptEngineer.initial_system_prompt()},
+        {'role': 'assistant', 'content': PromptEngineer.initial_response()},
+        {'role': 'user', 'content': PromptEngineer.construct_questions_prompt(["Как себя чувствуете?"], "Общие вопросы")},
+        {'role': 'assistant', 'content': "Как вы себя чувствуете?"},
+        {'role': 'user', 'content': 'Пациент: "Хорошо"'},
+        {'role': 'assistant', 'content': "А как аппетит?"},
+        {'role': 'user', 'content': 'Пациент: "Нормально"'},
+    ]
+
+def short_system():
+    return {'role': 'system', 'content': PromptEngineer.initial_system_prompt_short()}
+
+def test_compress_keeps_short_system_prompt_and_tail():
+    messages = conversation()
+    compressed = PromptEngineer.compress_messages(messages, 2)
+    assert compressed[0] == short_system()
+    assert compressed[-2:] == messages[-2:]
+
+def test_compress_keeps_latest_questions_prompt():
+    messages = conversation()
+    compressed = PromptEngineer.compress_messages(messages, 2)
+    assert compressed[1] == messages[2]
+    assert len(compressed) == 4
+
+def test_compress_does_not_duplicate_questions_prompt_in_tail():
+    messages = conversation()
+    assert PromptEngineer.compress_messages(messages, 10) == [short_system()] + messages[1:]
+
+def test_compress_empty():
+    assert PromptEngineer.compress_messages([], 5) == []
+
+def test_prompt_kinds():
+    questions = {'role': 'user', 'content': PromptEngineer.construct_questions_prompt(["Вопрос"], "Тема")}
+    if_question = {'role': 'user', 'content': PromptEngineer.construct_if_question_prompt(["Вопрос?"], "Тема")}
+    answers = {'role': 'user', 'content': PromptEngineer.prompt_answers_list([{'id': 1, 'text': "Вопрос"}])}
+    assert PromptEngineer.is_questions_prompt(questions) and not PromptEngineer.is_if_question_prompt(questions)
+    assert PromptEngineer.is_if_question_prompt(if_question)
+    assert PromptEngineer.is_answers_list_prompt(answers) and not PromptEngineer.is_questions_prompt(answers)
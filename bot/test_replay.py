@@ -0,0 +1,168 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from bot.prompt_engineer import PromptEngineer
+from bot.replay import (
+    CassetteLLM, StubLLM, is_answer_correct, pick_completed_transcript, replay_script, summarize
+)
+from utils.database import REPLAY_CHAT_ID_BASE
+
+SCRIPT = {
+    "name": "diabetic",
+    "messages": [
+        "Нормально", "Здравствуйте", "Хорошо себя чувствую", "Придерживаюсь",
+        "Да, есть диабет", "Да, есть глюкометр", "Нет, не принимаю", "Лишняя реплика",
+    ],
+    "answers": {"1": "хорошо себя чувствую", "7": "Да", "8": "глюкометр", "9": "Да"},
+}
+
+def questions_prompt(questions):
+    return {'role': 'user', 'content': PromptEngineer.construct_questions_prompt(questions, "Тема")}
+
+def if_prompt(question):
+    return {'role': 'user', 'content': PromptEngineer.construct_if_question_prompt([question], "Тема")}
+
+def patient(text):
+    return {'role': 'user', 'content': f'Пациент: "{text}"'}
+
+def test_stub_asks_first_question_of_batch():
+    assert StubLLM().reply([questions_prompt(["Первый?", "Второй?"])]) == "Первый?"
+
+def test_stub_tags():
+    llm = StubLLM()
+    assert llm.reply([questions_prompt(["Вопрос?"]), patient("Ответ")]).endswith("\\done")
+    assert llm.reply([if_prompt("Есть диабет?"), patient("Да, есть")]) == "\\yes"
+    assert llm.reply([if_prompt("Есть диабет?"), patient("Нет")]) == "\\no"
+
+def test_stub_extracts_answers():
+    messages = [
+        questions_prompt(["Как себя чувствуете?"]), {'role': 'assistant', 'content': "Как вы?"}, patient("Хорошо"),
+        {'role': 'user', 'content': PromptEngineer.prompt_answers_list([{'id': 1, 'text': "Как себя чувствуете?"}, {'id': 2, 'text': "Не спрошен"}])},
+    ]
+    answer, usage = StubLLM().generate_with_usage(messages)
+    assert answer == "1: Хорошо\n2: None"
+    assert usage["prompt_tokens"] > 0 and usage["completion_tokens"] > 0
+
+class CountingBackend:
+    cooldown = 0
+
+    def __init__(self):
+        self.calls = 0
+
+    def generate_with_usage(self, messages, model=None):
+        self.calls += 1
+        return f"ответ {self.calls}", {"model": "m", "prompt_tokens": 7, "completion_tokens": 3}
+
+def test_cassette_replays_by_position_after_prompt_change(tmp_path):
+    path = str(tmp_path / "cassette.json")
+    recorder = CassetteLLM(path, CountingBackend())
+    recorder.start_turn(1)
+    assert recorder.generate([patient("старый промпт")]) == "ответ 1"
+    assert recorder.generate([patient("второй вызов")]) == "ответ 2"
+    recorder.save()
+
+    player = CassetteLLM(path)
+    player.start_turn(1)
+    answer, usage = player.generate_with_usage([patient("новый, заметно более длинный промпт")])
+    assert answer == "ответ 1"
+    assert usage["prompt_tokens"] != 7 and usage["completion_tokens"] == 3
+    assert player.generate_with_usage([patient("второй вызов")]) == ("ответ 2", {"model": "m", "prompt_tokens": 7, "completion_tokens": 3})
+    with pytest.raises(KeyError):
+        player.generate([patient("третий вызов")])
+
+def test_cassette_strict_mode(tmp_path):
+    path = str(tmp_path / "cassette.json")
+    recorder = CassetteLLM(path, CountingBackend())
+    recorder.generate([patient("промпт")])
+    recorder.save()
+
+    strict = CassetteLLM(path, strict=True)
+    assert strict.generate([patient("промпт")]) == "ответ 1"
+    strict.start_turn(0)
+    with pytest.raises(KeyError):
+        strict.generate([patient("другой промпт")])
+
+def test_is_answer_correct():
+    assert is_answer_correct("Да", " да ")
+    assert is_answer_correct("глюкометр", "Да, есть глюкометр")
+    assert not is_answer_correct("Нет", "Да")
+    assert not is_answer_correct("Да", None)
+
+def test_pick_completed_transcript():
+    t0 = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    first = [{'role': 'user', 'content': 'Пациент: "1"', 'created_at': t0}]
+    second = [{'role': 'user', 'content': 'Пациент: "2"', 'created_at': t0 + timedelta(days=1)}]
+    third = [{'role': 'user', 'content': 'Пациент: "3"', 'created_at': t0 + timedelta(days=2)}]
+    submissions = [(t0 + timedelta(hours=1), {1: "first"}), (t0 + timedelta(days=1, hours=1), {1: "second"})]
+    assert pick_completed_transcript([first, second, third], submissions) == (second, {1: "second"})
+    assert pick_completed_transcript([first, second], submissions[:1]) == (first, {1: "first"})
+    assert pick_completed_transcript([first], []) == (None, None)
+
+def test_replay_with_stub(fake_db):
+    result = asyncio.run(replay_script(SCRIPT, StubLLM(), REPLAY_CHAT_ID_BASE - 1))
+    assert result["completed"]
+    assert result["turns"] == 7
+    assert (result["yes_no_tag_failures"], result["turns_without_done"]) == (0, 0)
+    assert result["analysis_calls"] == 2
+    assert set(result["llm_calls_per_stage"]) == {0, 1}
+    assert len(result["prompt_tokens_per_turn"]) == 7
+    assert result["prompt_tokens_per_turn"][0] == 0 # the theme question is not generated
+    assert (result["expected_answers"], result["correct_answers"]) == (4, 3)
+
+class ForgetfulStub(StubLLM):
+    '''Forgets the \\yes/\\no tag the first time it is due'''
+    def __init__(self):
+        self.forgot = False
+
+    def reply(self, messages):
+        answer = super().reply(messages)
+        if answer in ("\\yes", "\\no") and not self.forgot:
+            self.forgot = True
+            return "Уточните, пожалуйста."
+        return answer
+
+def test_replay_counts_tag_failures(fake_db):
+    script = dict(SCRIPT, messages=SCRIPT["messages"][:5] + ["Да, есть"] + SCRIPT["messages"][5:])
+    result = asyncio.run(replay_script(script, ForgetfulStub(), REPLAY_CHAT_ID_BASE - 2))
+    assert (result["yes_no_tag_failures"], result["turns_without_done"]) == (1, 0)
+    assert result["completed"] and result["turns"] == 8
+
+class DoneForgettingStub(StubLLM):
+    '''Forgets the \\done tag the first time it is due'''
+    def __init__(self):
+        self.forgot = False
+
+    def reply(self, messages):
+        answer = super().reply(messages)
+        if "\\done" in answer and not self.forgot:
+            self.forgot = True
+            return "Уточните, пожалуйста."
+        return answer
+
+def test_replay_counts_turns_without_done(fake_db):
+    script = dict(SCRIPT, messages=SCRIPT["messages"][:2] + ["Повторю"] + SCRIPT["messages"][2:])
+    result = asyncio.run(replay_script(script, DoneForgettingStub(), REPLAY_CHAT_ID_BASE - 3))
+    assert (result["yes_no_tag_failures"], result["turns_without_done"]) == (0, 1)
+    assert result["completed"] and result["turns"] == 8
+
+def test_summarize():
+    results = [
+        {"name": "a", "completed": True, "turns": 6, "llm_calls_per_stage": {0: 2, 1: 4}, "prompt_tokens_per_turn": [0, 100, 200],
+         "yes_no_tag_failures": 1, "turns_without_done": 2, "expected_answers": 4, "correct_answers": 3},
+        {"name": "b", "completed": False, "turns": 10, "llm_calls_per_stage": {0: 4}, "prompt_tokens_per_turn": [300],
+         "yes_no_tag_failures": 0, "turns_without_done": 1, "expected_answers": 2, "correct_answers": 0},
+        {"name": "c", "error": "KeyError()"},
+    ]
+    assert summarize(results) == {
+        "scripts": 3,
+        "errors": 1,
+        "completed": 1,
+        "mean_turns_to_completion": 6,
+        "mean_llm_calls_per_stage": {0: 3, 1: 4},
+        "mean_prompt_tokens_per_turn": 150,
+        "yes_no_tag_failures": 1,
+        "turns_without_done": 3,
+        "answer_accuracy": 0.75,
+    }
@@ -0,0 +1,92 @@
+import os
+
+import pytest
+
+# utils.config reads these at import time; tests never reach Telegram, Mistral or Postgres
+os.environ.setdefault("MISTRAL_TOKEN", "test")
+os.environ.setdefault("MISTRAL_MODEL", "mistral-large-latest")
+os.environ.setdefault("DEBUG", "False")
+
+class FakeDatabase:
+    '''In-memory stand-in for utils.database.Database with the semantics the conversation code relies on'''
+    def __init__(self, chat_id=None, shard=None, tenant=None):
+        self.store = FakeDatabase.store
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def log_offset(self, chat_id):
+        return self.store['convs'].get(chat_id, {}).get('log_offset', 0)
+
+    async def last_message_id(self, chat_id):
+        ids = [m['message_id'] for m in self.store['chatlogs'] if m['chat_id'] == chat_id]
+        return max(ids + [self.log_offset(chat_id)])
+
+    async def restart_conv(self, chat_id):
+        log_offset = await self.last_message_id(chat_id)
+        self.store['convs'][chat_id] = {
+            'stage_id': 0, 'batch_id': -1, 'is_started': False, 'is_concluded': False, 'set_theme': False,
+            'log_offset': log_offset, 'tokens_used': 0,
+        }
+        return log_offset
+
+    async def archive_chatlogs(self, chat_id, up_to):
+        moved = [m for m in self.store['chatlogs'] if m['chat_id'] == chat_id and m['message_id'] <= up_to]
+        self.store['chatlogs'] = [m for m in self.store['chatlogs'] if m not in moved]
+        if moved:
+            self.store['archive'].append({'chat_id': chat_id, 'messages': moved})
+        return len(moved)
+
+    async def start_conv(self, chat_id):
+        self.store['convs'][chat_id]['is_started'] = True
+
+    async def end_conv(self, chat_id):
+        self.store['convs'][chat_id]['is_concluded'] = True
+
+    async def get_conv_stage(self, chat_id):
+        if chat_id not in self.store['convs']:
+            await self.restart_conv(chat_id)
+        conv = self.store['convs'][chat_id]
+        return conv['stage_id'], conv['batch_id'], conv['is_started'], conv['is_concluded'], conv['set_theme']
+
+    async def set_conv_stage(self, chat_id, stage_id, batch_id, is_started, is_concluded, set_theme):
+        self.store['convs'][chat_id].update(stage_id=stage_id, batch_id=batch_id, is_started=is_started, is_concluded=is_concluded, set_theme=set_theme)
+
+    async def get_messages(self, chat_id):
+        return [
+            {'role': m['role'], 'content': m['message_text']} for m in self.store['chatlogs']
+            if m['chat_id'] == chat_id and m['message_id'] > self.log_offset(chat_id)
+        ]
+
+    async def add_message(self, chat_id, message_text, role, stage_id):
+        message_id = await self.last_message_id(chat_id) + 1
+        self.store['chatlogs'].append({'chat_id': chat_id, 'message_id': message_id, 'message_text': message_text, 'role': role, 'stage_id': stage_id})
+
+    async def get_stage_messages(self, chat_id, stage_id):
+        return [
+            {'role': m['role'], 'content': m['message_text']} for m in self.store['chatlogs']
+            if m['chat_id'] == chat_id and m['stage_id'] == stage_id and m['message_id'] > self.log_offset(chat_id)
+        ]
+
+    async def add_token_usage(self, chat_id, stage_id, kind, usage):
+        self.store['token_usage'].append(dict(usage, chat_id=chat_id, stage_id=stage_id, kind=kind))
+        self.store['convs'][chat_id]['tokens_used'] += usage['prompt_tokens'] + usage['completion_tokens']
+
+    async def get_tokens_used(self, chat_id):
+        return self.store['convs'].get(chat_id, {}).get('tokens_used', 0)
+
+    async def insert_answers(self, chat_id, questions, answers):
+        self.store['answers'].extend((chat_id, question['id'], answers.get(question['id'])) for question in questions)
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    '''Replaces the database of the conversation code with FakeDatabase and returns its store'''
+    import bot.answers_analyzer
+    import bot.conversation
+    FakeDatabase.store = {'convs': {}, 'chatlogs': [], 'archive': [], 'answers': [], 'token_usage': []}
+    monkeypatch.setattr(bot.conversation, "Database", FakeDatabase)
+    monkeypatch.setattr(bot.answers_analyzer, "Database", FakeDatabase)
+    return FakeDatabase.store
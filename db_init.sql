@@ -6,22 +6,77 @@ CREATE TABLE IF NOT EXISTS public.convs
     has_questions boolean NOT NULL DEFAULT FALSE,
     set_theme boolean NOT NULL DEFAULT FALSE,
     stage_id integer NOT NULL,
-    batch_id integer NOT NULL
+    batch_id integer NOT NULL,
+    log_offset bigint NOT NULL DEFAULT 0,
+    tokens_used bigint NOT NULL DEFAULT 0
 );
 
+-- Idempotent migrations of databases created before the columns above, applied by Database.init_schema
+ALTER TABLE public.convs ADD COLUMN IF NOT EXISTS log_offset bigint NOT NULL DEFAULT 0;
+ALTER TABLE public.convs ADD COLUMN IF NOT EXISTS tokens_used bigint NOT NULL DEFAULT 0;
+
+-- Live queries look up convs by chat_id on every message. Older databases may hold duplicate rows, which are dropped once before the index is built
+DO $$
+BEGIN
+    IF to_regclass('public.convs_chat_id_idx') IS NULL THEN
+        DELETE FROM public.convs a USING public.convs b WHERE a.chat_id = b.chat_id AND a.ctid < b.ctid;
+    END IF;
+END $$;
+CREATE UNIQUE INDEX IF NOT EXISTS convs_chat_id_idx ON public.convs (chat_id);
+
 CREATE TABLE IF NOT EXISTS public.chatlogs
 (
     chat_id bigint NOT NULL,
     message_id bigint NOT NULL,
     message_text text NOT NULL,
     stage_id integer NOT NULL,
-    role text NOT NULL
+    role text NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+
+ALTER TABLE public.chatlogs ADD COLUMN IF NOT EXISTS created_at timestamptz NOT NULL DEFAULT now();
+
+CREATE INDEX IF NOT EXISTS chatlogs_chat_id_message_id_idx ON public.chatlogs (chat_id, message_id);
+
+CREATE TABLE IF NOT EXISTS public.chatlogs_archive
+(
+    chat_id bigint NOT NULL,
+    first_message_id bigint NOT NULL,
+    last_message_id bigint NOT NULL,
+    archived_at timestamptz NOT NULL DEFAULT now(),
+    messages jsonb NOT NULL
 );
 
+CREATE INDEX IF NOT EXISTS chatlogs_archive_chat_id_idx ON public.chatlogs_archive (chat_id);
+
 CREATE TABLE IF NOT EXISTS public.answers
 (
     chat_id bigint NOT NULL,
     question_id bigint NOT NULL,
     question_text text NOT NULL,
-    answer_text text NOT NULL
-);
\ No newline at end of file
+    answer_text text,
+    answered_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- Idempotent migrations of databases created before the columns above, applied by Database.init_schema
+-- Answers existing at this point all get the migration time, so their submissions cannot be told apart
+ALTER TABLE public.answers ADD COLUMN IF NOT EXISTS answered_at timestamptz NOT NULL DEFAULT now();
+ALTER TABLE public.answers ALTER COLUMN answer_text DROP NOT NULL;
+
+CREATE INDEX IF NOT EXISTS answers_answered_at_idx ON public.answers (answered_at, chat_id);
+
+CREATE TABLE IF NOT EXISTS public.token_usage
+(
+    chat_id bigint NOT NULL,
+    conv_id bigint NOT NULL DEFAULT 0, -- convs.log_offset at the time of the call, tells apart conversations of one chat
+    stage_id integer NOT NULL,
+    kind text NOT NULL,
+    model text NOT NULL,
+    prompt_tokens integer NOT NULL,
+    completion_tokens integer NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+
+ALTER TABLE public.token_usage ADD COLUMN IF NOT EXISTS conv_id bigint NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS token_usage_chat_id_idx ON public.token_usage (chat_id);
\ No newline at end of file
@@ -0,0 +1,228 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from bot.answers_export import EXPORT_LAG, FORMATS, export_answers
+from bot.prompt_engineer import PromptEngineer
+from bot.replay import load_scripts, replay_all, script_from_chatlogs, summarize
+from utils.database import SHARDED_TABLES, Database
+from utils.tenants import bucket_shard, current_tenant, even_bucket_map, find_tenant, get_tenant, load_tenants
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+def parse_timestamp(value: str) -> datetime:
+    '''Parses an ISO timestamp, taking one without a timezone as UTC, so that it compares with the timestamptz bounds of the database'''
+    timestamp = datetime.fromisoformat(value)
+    return timestamp if timestamp.tzinfo is not None else timestamp.replace(tzinfo=timezone.utc)
+
+def read_watermarks(path):
+    '''Reads per shard export watermarks, {shard: datetime}, from a json file'''
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as file:
+        return {int(shard): parse_timestamp(watermark) for shard, watermark in json.load(file).items()}
+
+def write_watermarks(path, watermarks):
+    if path is None:
+        return
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({str(shard): watermark.isoformat() for shard, watermark in watermarks.items()}, file, indent=1)
+
+async def migrate_command(args):
+    for shard in range(len(get_tenant().shards)):
+        async with Database(shard=shard) as db:
+            await db.init_schema()
+        log.info(f"Migrated shard {shard} of tenant {get_tenant().name}")
+
+async def export_command(args):
+    if args.since:
+        since = dict.fromkeys(range(len(get_tenant().shards)), args.since)
+    else:
+        since = read_watermarks(args.watermark_file)
+    watermarks = await export_answers(args.output, args.format, since, timedelta(seconds=args.lag_seconds))
+    write_watermarks(args.watermark_file, watermarks)
+    print(json.dumps({str(shard): watermark.isoformat() for shard, watermark in watermarks.items()}))
+
+async def archive_command(args):
+    concluded_before = datetime.now(timezone.utc) - timedelta(days=args.older_than_days)
+    archived = 0
+    convs = 0
+    for shard in range(len(get_tenant().shards)):
+        async with Database(shard=shard) as db:
+            shard_convs = await db.get_archivable_convs(concluded_before)
+            for chat_id, up_to in shard_convs:
+                archived += await db.archive_conv(chat_id, up_to)
+        convs += len(shard_convs)
+    log.info(f"Archived {archived} messages of {convs} conversations")
+
+def percentile(values, q):
+    values = sorted(values)
+    position = (len(values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+async def tokens_command(args):
+    report = {}
+    for shard in range(len(get_tenant().shards)):
+        async with Database(shard=shard) as db:
+            async for entry in db.iter_token_totals():
+                stats = report.setdefault((entry['stage_id'], entry['kind']), {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'per_conv': []})
+                stats['calls'] += entry['calls']
+                stats['prompt_tokens'] += entry['prompt_tokens']
+                stats['completion_tokens'] += entry['completion_tokens']
+                stats['per_conv'].append(entry['prompt_tokens'] + entry['completion_tokens'])
+    total = sum(stats['prompt_tokens'] + stats['completion_tokens'] for stats in report.values()) or 1
+    print(f"{'stage':<50} {'kind':<12} {'convs':>6} {'calls':>7} {'prompt':>10} {'completion':>10} {'share':>6} {'p50/conv':>9} {'p90/conv':>9}")
+    for (stage_id, kind), stats in sorted(report.items()):
+        stage = PromptEngineer.get_stage(stage_id).get('name', str(stage_id))
+        tokens = stats['prompt_tokens'] + stats['completion_tokens']
+        print(
+            f"{stage[:50]:<50} {kind:<12} {len(stats['per_conv']):>6} {stats['calls']:>7} "
+            f"{stats['prompt_tokens']:>10} {stats['completion_tokens']:>10} {tokens / total:>6.1%} "
+            f"{percentile(stats['per_conv'], 0.5):>9.0f} {percentile(stats['per_conv'], 0.9):>9.0f}"
+        )
+
+async def replay_command(args):
+    if not args.tenant:
+        raise SystemExit("Replays write conversations into the tenant database, pass --tenant with a dedicated replay tenant")
+    for shard in range(len(get_tenant().shards)):
+        async with Database(shard=shard) as db:
+            if await db.has_real_chats():
+                raise SystemExit(f"Tenant {get_tenant().name} holds real conversations, replays need a dedicated tenant")
+    scripts = load_scripts(args.scripts)
+    if args.from_chat:
+        source = find_tenant(args.from_tenant) if args.from_tenant else load_tenants()[0]
+        token = current_tenant.set(source)
+        try:
+            for chat_id in args.from_chat:
+                scripts.append(await script_from_chatlogs(chat_id))
+        finally:
+            current_tenant.reset(token)
+            await source.close()
+    if args.save_scripts:
+        with open(args.save_scripts, 'w', encoding='utf-8') as file:
+            json.dump(scripts, file, ensure_ascii=False, indent=1)
+    if not scripts:
+        log.warning("No scripts to replay")
+        return
+    if args.backend == "cassette" and not args.cassette_dir:
+        raise SystemExit("--cassette-dir is required for the cassette backend")
+    if args.cassette_dir:
+        os.makedirs(args.cassette_dir, exist_ok=True)
+    results = replay_all(scripts, args.backend, args.cassette_dir, args.record, args.strict, args.tenant, args.processes)
+    summary = summarize(results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump({"summary": summary, "results": results}, file, ensure_ascii=False, indent=1)
+    print(json.dumps(summary, ensure_ascii=False, indent=1))
+
+async def move_buckets(source: int, target: int, buckets: list[int], batch_size: int = 1000) -> Optional[datetime]:
+    '''Moves all rows of chats in buckets from the source shard to the target one. Safe to rerun after an interruption:
+    tables still present on the source are copied again from scratch, tables already deleted from it are left alone.
+    Returns the oldest answered_at of the moved answers, None if no answers were moved.'''
+    oldest_answer = None
+    async with Database(shard=source) as source_db, Database(shard=target) as target_db:
+        for table in SHARDED_TABLES:
+            if not await source_db.has_bucket_rows(table, buckets):
+                continue
+            await target_db.delete_bucket_rows(table, buckets)
+            batch = []
+            async for record in source_db.iter_bucket_rows(table, buckets):
+                if table == 'answers' and record['answered_at'] is not None:
+                    oldest_answer = min(oldest_answer or record['answered_at'], record['answered_at'])
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    await target_db.copy_rows(table, batch)
+                    batch = []
+            await target_db.copy_rows(table, batch)
+            log.info(f"Copied {table} from shard {source} to shard {target}")
+        for table in SHARDED_TABLES:
+            await source_db.delete_bucket_rows(table, buckets)
+    return oldest_answer
+
+def lower_watermark(watermarks: dict, shard: int, oldest_answer: datetime):
+    '''Moves the export watermark of the shard before oldest_answer, so that the next incremental export includes answers moved there'''
+    if shard in watermarks and watermarks[shard] >= oldest_answer:
+        watermarks[shard] = oldest_answer - timedelta(microseconds=1)
+
+async def reshard_command(args):
+    tenant = get_tenant()
+    old_map = json.loads(args.old_map) if args.old_map else even_bucket_map(tenant.buckets, args.old_shards)
+    moves = {}
+    for bucket in range(tenant.buckets):
+        source, target = bucket_shard(old_map, bucket), bucket_shard(tenant.bucket_map, bucket)
+        if source != target:
+            moves.setdefault((source, target), []).append(bucket)
+    if moves and not args.watermark_file:
+        log.warning("No --watermark-file given: incremental exports will miss moved answers older than the watermark of their new shard")
+    watermarks = read_watermarks(args.watermark_file)
+    for (source, target), buckets in sorted(moves.items()):
+        log.info(f"Moving {len(buckets)} buckets from shard {source} to shard {target}")
+        oldest_answer = await move_buckets(source, target, buckets)
+        if oldest_answer is not None:
+            lower_watermark(watermarks, target, oldest_answer)
+            write_watermarks(args.watermark_file, watermarks)
+    log.info(f"Resharding of tenant {tenant.name} done, {sum(len(buckets) for buckets in moves.values())} buckets moved")
+
+async def run(args):
+    if args.tenant:
+        current_tenant.set(find_tenant(args.tenant))
+    try:
+        await args.func(args)
+    finally:
+        await get_tenant().close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Follow up bot maintenance commands")
+    parser.add_argument("--tenant", help="Tenant to run the command for, the first configured one by default")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = subparsers.add_parser("migrate", help="Create missing tables and columns on every shard of the tenant")
+    migrate_parser.set_defaults(func=migrate_command)
+
+    export_parser = subparsers.add_parser("export", help="Export questionnaire answers, one row per patient")
+    export_parser.add_argument("output", help="Output file path")
+    export_parser.add_argument("--format", choices=FORMATS, default="csv")
+    export_parser.add_argument("--since", type=parse_timestamp, help="Export only answers written after this ISO timestamp, UTC if it has no timezone")
+    export_parser.add_argument("--watermark-file", help="Json file to read the last per shard watermarks from and write the new ones to, for incremental exports")
+    export_parser.add_argument("--lag-seconds", type=int, default=int(EXPORT_LAG.total_seconds()), help="Leave answers written less than this ago for the next export, so that no uncommitted rows are skipped")
+    export_parser.set_defaults(func=export_command)
+
+    archive_parser = subparsers.add_parser("archive", help="Move restarted and finished conversations from chatlogs to chatlogs_archive")
+    archive_parser.add_argument("--older-than-days", type=int, default=7, help="Archive concluded conversations idle for this many days")
+    archive_parser.set_defaults(func=archive_command)
+
+    tokens_parser = subparsers.add_parser("tokens", help="Show the token cost distribution across questionnaire stages")
+    tokens_parser.set_defaults(func=tokens_command)
+
+    replay_parser = subparsers.add_parser("replay", help="Replay patient scripts through the conversation and report speed and quality metrics")
+    replay_parser.add_argument("scripts", nargs="*", help="Script json files or directories of them")
+    replay_parser.add_argument("--from-chat", type=int, action="append", default=[], help="Also replay the recorded conversation of this chat id")
+    replay_parser.add_argument("--from-tenant", help="Tenant to read --from-chat conversations from, the first configured one by default")
+    replay_parser.add_argument("--save-scripts", help="Write all loaded scripts to this json file")
+    replay_parser.add_argument("--backend", choices=("stub", "cassette"), default="stub")
+    replay_parser.add_argument("--cassette-dir", help="Directory with one recorded-response cassette per script")
+    replay_parser.add_argument("--record", action="store_true", help="Request missing cassette responses from Mistral and record them")
+    replay_parser.add_argument("--strict", action="store_true", help="Replay cassette responses only for the exact requests they were recorded for")
+    replay_parser.add_argument("--processes", type=int, help="Number of worker processes, CPU count by default")
+    replay_parser.add_argument("--output", help="Write the summary and per-script metrics to this json file")
+    replay_parser.set_defaults(func=replay_command)
+
+    reshard_parser = subparsers.add_parser("reshard", help="Move chats to the shards given by the current bucket_map of the tenant. Stop the bot first")
+    reshard_group = reshard_parser.add_mutually_exclusive_group(required=True)
+    reshard_group.add_argument("--old-map", help="Bucket map in use before the change, as json, e.g. '[[0, 0], [512, 1]]'")
+    reshard_group.add_argument("--old-shards", type=int, help="Number of shards before the change, if the default even bucket map was used")
+    reshard_parser.add_argument("--watermark-file", help="Export watermark file to lower for shards that receive answers, so that incremental exports include them")
+    reshard_parser.set_defaults(func=reshard_command)
+
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from manage import lower_watermark, parse_timestamp, percentile, read_watermarks
+
+def test_percentile_interpolates():
+    assert percentile([1, 2, 3, 4], 0.5) == 2.5
+    assert percentile([10, 0, 20], 0.5) == 10
+
+def test_percentile_bounds():
+    values = [5, 1, 9]
+    assert percentile(values, 0) == 1
+    assert percentile(values, 1) == 9
+    assert percentile([7], 0.9) == 7
+
+def test_percentile_p90():
+    assert percentile(list(range(11)), 0.9) == pytest.approx(9)
+
+def test_parse_timestamp_defaults_to_utc():
+    assert parse_timestamp("2024-01-01") == datetime(2024, 1, 1, tzinfo=timezone.utc)
+    assert parse_timestamp("2024-01-01T03:00:00+03:00").utcoffset() == timedelta(hours=3)
+
+def test_read_watermarks_are_timezone_aware(tmp_path):
+    path = tmp_path / "export.watermark"
+    path.write_text(json.dumps({"0": "2024-01-01T00:00:00", "1": "2024-01-02T00:00:00+00:00"}))
+    watermarks = read_watermarks(str(path))
+    assert watermarks == {0: datetime(2024, 1, 1, tzinfo=timezone.utc), 1: datetime(2024, 1, 2, tzinfo=timezone.utc)}
+
+def test_lower_watermark():
+    watermark = datetime(2024, 6, 1, tzinfo=timezone.utc)
+    watermarks = {0: watermark, 1: watermark}
+    lower_watermark(watermarks, 0, datetime(2024, 1, 1, tzinfo=timezone.utc))
+    lower_watermark(watermarks, 1, datetime(2024, 7, 1, tzinfo=timezone.utc))
+    lower_watermark(watermarks, 2, datetime(2024, 1, 1, tzinfo=timezone.utc))
+    assert watermarks == {0: datetime(2023, 12, 31, 23, 59, 59, 999999, tzinfo=timezone.utc), 1: watermark}
@@ -2,13 +2,18 @@ import os
 
 
 cfg = {
-    "db_host": os.environ["DB_HOST"],
-    "db_port": int(os.environ["DB_PORT"]),
-    "db_user": os.environ["DB_USER"],
-    "db_name": os.environ["DB_NAME"],
-    "db_password": os.environ["DB_PASSWORD"],
-    "bot_token": os.environ["BOT_TOKEN"],
+    "tenants_file": os.environ.get("TENANTS_FILE"), # if set, db and bot settings below are taken from it per tenant
+    "db_host": os.environ.get("DB_HOST"),
+    "db_port": int(os.environ.get("DB_PORT", 5432)),
+    "db_user": os.environ.get("DB_USER"),
+    "db_name": os.environ.get("DB_NAME"),
+    "db_password": os.environ.get("DB_PASSWORD"),
+    "bot_token": os.environ.get("BOT_TOKEN"),
+    "stages_file": os.environ.get("STAGES_FILE", "test_stages.json"), # change to stages.json for production
     "mistral_token": os.environ["MISTRAL_TOKEN"],
     "mistral_model": os.environ["MISTRAL_MODEL"],
-    "debug": os.environ["DEBUG"] == "True"
+    "debug": os.environ["DEBUG"] == "True",
+    "token_budget": int(os.environ.get("TOKEN_BUDGET", 0)), # tokens per conversation, 0 means unlimited
+    "budget_model": os.environ.get("BUDGET_MODEL", "mistral-small-latest"),
+    "budget_context": int(os.environ.get("BUDGET_CONTEXT", 10)) # messages kept in the context after the budget is exceeded
 }
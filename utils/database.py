@@ -1,41 +1,112 @@
-from typing import Tuple
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Optional, Tuple
+import os
 import asyncpg
-from utils.config import cfg
+from utils.tenants import Tenant, get_tenant
 import logging
 
 log = logging.getLogger(__name__)
 
+REPLAY_CHAT_ID_BASE = -9 * 10 ** 15 # chat ids at or below this are synthetic replay conversations, far below real Telegram chat ids
+SHARDED_TABLES = ('convs', 'chatlogs', 'chatlogs_archive', 'answers', 'token_usage') # tables keyed by chat_id, moved by resharding
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'db_init.sql')
+
 class Database:
-    def __init__(self):
+    '''Connection to the shard of the current tenant that stores chat_id. Without chat_id, connects to the given shard (0 by default),
+    which is used by maintenance commands that iterate over all shards.'''
+    def __init__(self, chat_id: Optional[int] = None, shard: Optional[int] = None, tenant: Optional[Tenant] = None):
+        self.tenant = tenant if tenant is not None else get_tenant()
+        if shard is None:
+            shard = self.tenant.shard_for(chat_id) if chat_id is not None else 0
+        self.shard = shard
+        self.pool: asyncpg.Pool = ...
         self.conn: asyncpg.Connection = ...
 
     async def connect(self):
-        self.conn: asyncpg.Connection = await asyncpg.connect(
-            host=cfg['db_host'],
-            port=cfg['db_port'],
-            user=cfg['db_user'],
-            database=cfg['db_name'],
-            password=cfg['db_password']
-        )
+        self.pool = await self.tenant.get_pool(self.shard)
+        self.conn: asyncpg.Connection = await self.pool.acquire()
 
-    async def restart_conv(self, chat_id: int):
-        '''Deletes conversation chat_id and creates an empty new one'''
-        await self.conn.execute(
-            "DELETE FROM convs WHERE chat_id=$1",
+    async def init_schema(self):
+        '''Creates missing tables and migrates existing ones by running db_init.sql, which is idempotent'''
+        with open(SCHEMA_FILE, 'r', encoding='utf-8') as file:
+            schema = file.read()
+        await self.conn.execute(schema)
+
+    async def last_message_id(self, chat_id: int) -> int:
+        '''Returns the last used message_id of the given chat_id. Message ids keep growing across restarts and archival.'''
+        return await self.conn.fetchval(
+            '''
+            SELECT GREATEST(
+                (SELECT COALESCE(MAX(message_id), 0) FROM chatlogs WHERE chat_id=$1),
+                (SELECT COALESCE(MAX(log_offset), 0) FROM convs WHERE chat_id=$1)
+            )
+            ''',
             chat_id
         )
-        await self.conn.execute(
-            "DELETE FROM chatlogs WHERE chat_id=$1",
-            chat_id
+
+    async def restart_conv(self, chat_id: int) -> int:
+        '''Resets conversation chat_id to an empty new one. Old messages are hidden behind log_offset and left for archive_chatlogs.
+        Returns the new log_offset.'''
+        async with self.conn.transaction():
+            log_offset = await self.last_message_id(chat_id)
+            # A single upsert, so that concurrent restarts of one chat reset the row instead of violating convs_chat_id_idx
+            await self.conn.execute(
+                '''
+                INSERT INTO convs (chat_id, is_started, is_concluded, set_theme, stage_id, batch_id, log_offset, tokens_used)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, 0)
+                ON CONFLICT (chat_id) DO UPDATE SET
+                    is_started=EXCLUDED.is_started, is_concluded=EXCLUDED.is_concluded, set_theme=EXCLUDED.set_theme,
+                    stage_id=EXCLUDED.stage_id, batch_id=EXCLUDED.batch_id, log_offset=EXCLUDED.log_offset, tokens_used=0
+                ''',
+                chat_id, False, False, False, 0, -1, log_offset
+            )
+        return log_offset
+
+    async def archive_chatlogs(self, chat_id: int, up_to: int) -> int:
+        '''Moves messages of chat_id with message_id up to up_to from chatlogs into one compressed jsonb row of chatlogs_archive.
+        Returns the number of archived messages.'''
+        return await self.conn.fetchval(
+            '''
+            WITH moved AS (
+                DELETE FROM chatlogs WHERE chat_id=$1 AND message_id <= $2
+                RETURNING chat_id, message_id, message_text, stage_id, role, created_at
+            ), archived AS (
+                INSERT INTO chatlogs_archive (chat_id, first_message_id, last_message_id, messages)
+                SELECT chat_id, MIN(message_id), MAX(message_id), jsonb_agg(
+                    jsonb_build_object('message_id', message_id, 'role', role, 'stage_id', stage_id, 'message_text', message_text, 'created_at', created_at)
+                    ORDER BY message_id
+                )
+                FROM moved GROUP BY chat_id
+            )
+            SELECT COUNT(*) FROM moved
+            ''',
+            chat_id, up_to
         )
-        await self.conn.execute(
+
+    async def get_archivable_convs(self, concluded_before: datetime) -> list[Tuple[int, int]]:
+        '''Returns (chat_id, up_to) for hot messages to archive: messages left behind by restarts,
+        and whole conversations that were concluded with the last message before concluded_before.'''
+        res = await self.conn.fetch(
             '''
-            INSERT INTO convs (chat_id, is_started, is_concluded, set_theme, stage_id, batch_id)
-            VALUES ($1, $2, $3, $4, $5, $6)
-            ''', 
-            chat_id, False, False, False, 0, -1
+            SELECT c.chat_id,
+                CASE WHEN c.is_concluded AND MAX(l.created_at) < $1 THEN MAX(l.message_id) ELSE c.log_offset END AS up_to
+            FROM convs c JOIN chatlogs l ON l.chat_id = c.chat_id
+            GROUP BY c.chat_id, c.is_concluded, c.log_offset
+            HAVING MIN(l.message_id) <= c.log_offset OR (c.is_concluded AND MAX(l.created_at) < $1)
+            ''',
+            concluded_before
         )
-    
+        return [(entry['chat_id'], entry['up_to']) for entry in res]
+
+    async def archive_conv(self, chat_id: int, up_to: int) -> int:
+        '''Moves log_offset of chat_id forward to up_to and archives its messages up to it.'''
+        async with self.conn.transaction():
+            await self.conn.execute(
+                "UPDATE convs SET log_offset = GREATEST(log_offset, $2) WHERE chat_id = $1",
+                chat_id, up_to
+            )
+            return await self.archive_chatlogs(chat_id, up_to)
+
     async def start_conv(self, chat_id: int):
         '''Sets is_started to True for the given chat_id'''
         await self.conn.execute(
@@ -70,18 +141,18 @@ class Database:
     async def get_messages(self, chat_id: int) -> list[dict]:
         '''Returns the messages for the given chat_id in the format [{'role': 'user', 'content': 'message_text'}, ...]'''
         res = await self.conn.fetch(
-            "SELECT role, message_text FROM chatlogs WHERE chat_id=$1 ORDER BY message_id",
+            '''
+            SELECT role, message_text FROM chatlogs
+            WHERE chat_id=$1 AND message_id > (SELECT COALESCE(MAX(log_offset), 0) FROM convs WHERE chat_id=$1)
+            ORDER BY message_id
+            ''',
             chat_id
         )
         return [{'role': entry['role'], 'content': entry['message_text']} for entry in res]
     
     async def add_message(self, chat_id: int, message_text: str, role: str, stage_id: int):
         '''Appends the message to the chatlogs of the given chat_id'''
-        max_message_id = await self.conn.fetchval(
-            "SELECT COALESCE(MAX(message_id), 0) FROM chatlogs WHERE chat_id=$1",
-            chat_id
-        )
-        message_id = max_message_id + 1
+        message_id = await self.last_message_id(chat_id) + 1
 
         await self.conn.execute(
             "INSERT INTO chatlogs (chat_id, message_id, message_text, role, stage_id) VALUES ($1, $2, $3, $4, $5)",
@@ -91,26 +162,172 @@ class Database:
     async def get_stage_messages(self, chat_id: int, stage_id: int):
         '''Returns the messages for a specific stage in the format [{'role': 'user', 'content': 'message_text'}, ...]'''
         res = await self.conn.fetch(
-            "SELECT role, message_text FROM chatlogs WHERE chat_id=$1 AND stage_id=$2 ORDER BY message_id",
+            '''
+            SELECT role, message_text FROM chatlogs
+            WHERE chat_id=$1 AND stage_id=$2 AND message_id > (SELECT COALESCE(MAX(log_offset), 0) FROM convs WHERE chat_id=$1)
+            ORDER BY message_id
+            ''',
             chat_id, stage_id
         )
         return [{'role': entry['role'], 'content': entry['message_text']} for entry in res]
 
-    async def insert_answers(self, chat_id: int, questions: dict, answers: dict):
-        '''Writes the answers in the database. Expects questions in the format [{'id': 1, 'text': 'question_text'}, ...] and answers in the format {1: 'answer_text', ...}'''
-        for question in questions:
-            answer_text = answers.get(question['id'])
+    async def add_token_usage(self, chat_id: int, stage_id: int, kind: str, usage: dict):
+        '''Records the token usage of one LLM call, as returned by MistralAPI.generate_with_usage, and adds it to the conversation total.
+        kind is "conversation" for replies to the patient and "analysis" for answer extraction.'''
+        async with self.conn.transaction():
             await self.conn.execute(
+                '''
+                INSERT INTO token_usage (chat_id, conv_id, stage_id, kind, model, prompt_tokens, completion_tokens)
+                VALUES ($1, (SELECT COALESCE(MAX(log_offset), 0) FROM convs WHERE chat_id=$1), $2, $3, $4, $5, $6)
+                ''',
+                chat_id, stage_id, kind, usage['model'], usage['prompt_tokens'], usage['completion_tokens']
+            )
+            await self.conn.execute(
+                "UPDATE convs SET tokens_used = tokens_used + $2 WHERE chat_id = $1",
+                chat_id, usage['prompt_tokens'] + usage['completion_tokens']
+            )
+
+    async def get_tokens_used(self, chat_id: int) -> int:
+        '''Returns the number of tokens spent on the current conversation of chat_id'''
+        res = await self.conn.fetchval(
+            "SELECT tokens_used FROM convs WHERE chat_id=$1",
+            chat_id
+        )
+        return res or 0
+
+    async def iter_token_totals(self, prefetch: int = 1000) -> AsyncIterator[asyncpg.Record]:
+        '''Streams token usage summed per conversation, stage and kind: chat_id, conv_id, stage_id, kind, calls, prompt_tokens, completion_tokens.
+        A conversation is a chat_id and conv_id pair, so restarted conversations of one chat are counted separately.'''
+        async with self.conn.transaction(isolation='repeatable_read', readonly=True):
+            cursor = self.conn.cursor(
+                '''
+                SELECT chat_id, conv_id, stage_id, kind, COUNT(*) AS calls,
+                    SUM(prompt_tokens) AS prompt_tokens, SUM(completion_tokens) AS completion_tokens
+                FROM token_usage WHERE chat_id > $1 GROUP BY chat_id, conv_id, stage_id, kind
+                ''',
+                REPLAY_CHAT_ID_BASE,
+                prefetch=prefetch
+            )
+            async for record in cursor:
+                yield record
+
+    async def insert_answers(self, chat_id: int, questions: dict, answers: dict):
+        '''Writes the answers in the database. Expects questions in the format [{'id': 1, 'text': 'question_text'}, ...] and answers in the format {1: 'answer_text', ...}.
+        All answers are written in one transaction so they share the same answered_at.'''
+        async with self.conn.transaction():
+            await self.conn.executemany(
                 '''
                 INSERT INTO public.answers (chat_id, question_id, question_text, answer_text)
                 VALUES ($1, $2, $3, $4)
-                ''', 
-                chat_id, question['id'], question['text'], answer_text
+                ''',
+                [(chat_id, question['id'], question['text'], answers.get(question['id'])) for question in questions]
+            )
+
+    async def get_transcripts(self, chat_id: int) -> list[list[dict]]:
+        '''Returns all recorded conversations of chat_id, oldest first, from chatlogs_archive and chatlogs.
+        Each is a list of messages in the format [{'role': 'user', 'content': 'message_text', 'created_at': datetime}, ...].'''
+        archived = await self.conn.fetch(
+            '''
+            SELECT a.first_message_id, m->>'role' AS role, m->>'message_text' AS message_text, (m->>'created_at')::timestamptz AS created_at
+            FROM chatlogs_archive a, jsonb_array_elements(a.messages) m
+            WHERE a.chat_id=$1
+            ORDER BY a.first_message_id, (m->>'message_id')::bigint
+            ''',
+            chat_id
+        )
+        hot = await self.conn.fetch(
+            '''
+            SELECT message_id > (SELECT COALESCE(MAX(log_offset), 0) FROM convs WHERE chat_id=$1) AS is_current,
+                role, message_text, created_at
+            FROM chatlogs WHERE chat_id=$1 ORDER BY message_id
+            ''',
+            chat_id
+        )
+        transcripts = {}
+        for entry in archived:
+            transcripts.setdefault(('archive', entry['first_message_id']), []).append(entry)
+        for entry in hot:
+            # Messages at or below log_offset belong to restarted conversations that are not archived yet
+            transcripts.setdefault(('hot', entry['is_current']), []).append(entry)
+        return [
+            [{'role': entry['role'], 'content': entry['message_text'], 'created_at': entry['created_at']} for entry in transcript]
+            for transcript in transcripts.values()
+        ]
+
+    async def get_answer_submissions(self, chat_id: int) -> list[Tuple[datetime, dict]]:
+        '''Returns all answer submissions of chat_id, oldest first, in the format [(answered_at, {question_id: 'answer_text', ...}), ...]'''
+        res = await self.conn.fetch(
+            "SELECT answered_at, question_id, answer_text FROM public.answers WHERE chat_id=$1 ORDER BY answered_at, question_id",
+            chat_id
+        )
+        submissions = {}
+        for entry in res:
+            submissions.setdefault(entry['answered_at'], {})[entry['question_id']] = entry['answer_text']
+        return list(submissions.items())
+
+    async def get_export_bound(self, lag: timedelta) -> datetime:
+        '''Returns the newest answered_at an export may include: the server time minus lag. answered_at is the start time of the
+        writing transaction, so rows older than the bound are assumed committed once lag exceeds the longest insert_answers transaction.'''
+        return await self.conn.fetchval("SELECT now() - $1::interval", lag)
+
+    async def iter_answers(self, since: Optional[datetime], until: datetime, prefetch: int = 1000) -> AsyncIterator[asyncpg.Record]:
+        '''Streams answers with since < answered_at <= until through a server-side cursor, ordered by answered_at, chat_id and question_id.
+        Runs in a read-only repeatable read transaction, so it sees a consistent snapshot and does not block the bot writes.'''
+        async with self.conn.transaction(isolation='repeatable_read', readonly=True):
+            cursor = self.conn.cursor(
+                '''
+                SELECT chat_id, question_id, answer_text, answered_at FROM public.answers
+                WHERE ($1::timestamptz IS NULL OR answered_at > $1) AND answered_at <= $2 AND chat_id > $3
+                ORDER BY answered_at, chat_id, question_id
+                ''',
+                since, until, REPLAY_CHAT_ID_BASE,
+                prefetch=prefetch
+            )
+            async for record in cursor:
+                yield record
+
+    async def has_real_chats(self) -> bool:
+        '''Whether this shard holds conversations other than replays'''
+        return await self.conn.fetchval(
+            "SELECT EXISTS (SELECT 1 FROM convs WHERE chat_id > $1)",
+            REPLAY_CHAT_ID_BASE
+        )
+
+    async def has_bucket_rows(self, table: str, buckets: list[int]) -> bool:
+        '''Whether the table of this shard holds rows of chats in the given buckets of the tenant'''
+        assert table in SHARDED_TABLES
+        return await self.conn.fetchval(
+            f"SELECT EXISTS (SELECT 1 FROM {table} WHERE ((chat_id % $2) + $2) % $2 = ANY($1::int[]))",
+            buckets, self.tenant.buckets
+        )
+
+    async def iter_bucket_rows(self, table: str, buckets: list[int], prefetch: int = 1000) -> AsyncIterator[asyncpg.Record]:
+        '''Streams all rows of the table that belong to chats in the given buckets'''
+        assert table in SHARDED_TABLES
+        async with self.conn.transaction(isolation='repeatable_read', readonly=True):
+            cursor = self.conn.cursor(
+                f"SELECT * FROM {table} WHERE ((chat_id % $2) + $2) % $2 = ANY($1::int[])",
+                buckets, self.tenant.buckets,
+                prefetch=prefetch
             )
+            async for record in cursor:
+                yield record
+
+    async def copy_rows(self, table: str, records: list[asyncpg.Record]):
+        assert table in SHARDED_TABLES
+        if records:
+            await self.conn.copy_records_to_table(table, records=[tuple(record.values()) for record in records], columns=list(records[0].keys()))
+
+    async def delete_bucket_rows(self, table: str, buckets: list[int]):
+        assert table in SHARDED_TABLES
+        await self.conn.execute(
+            f"DELETE FROM {table} WHERE ((chat_id % $2) + $2) % $2 = ANY($1::int[])",
+            buckets, self.tenant.buckets
+        )
 
     async def __aenter__(self):
         await self.connect()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self.conn.close()
+        await self.pool.release(self.conn)
@@ -0,0 +1,119 @@
+import asyncio
+import bisect
+import contextvars
+import json
+import logging
+from typing import Optional
+
+import asyncpg
+from utils.config import cfg
+
+log = logging.getLogger(__name__)
+
+BUCKETS = 1024 # virtual buckets chat ids are hashed into, fixed for the lifetime of a tenant
+
+def even_bucket_map(buckets: int, shards: int) -> list[list[int]]:
+    '''Splits buckets into equal contiguous ranges, one per shard, in the bucket_map format'''
+    return [[shard * buckets // shards, shard] for shard in range(shards)]
+
+def bucket_shard(bucket_map: list[list[int]], bucket: int) -> int:
+    '''Returns the shard of the bucket. bucket_map is a list of [first_bucket, shard] ranges sorted by first_bucket, starting at 0.'''
+    return bucket_map[bisect.bisect_right([first for first, _ in bucket_map], bucket) - 1][1]
+
+class Tenant:
+    '''A clinic served by the bot: its own Telegram bot token, questionnaire and Postgres shards.
+    A tenant without a bot token is storage only: bot.py does not serve it, maintenance commands such as replay still use it.
+    A shard is either a DSN string or a dict of asyncpg connect arguments.
+    Chat ids are hashed into a fixed number of virtual buckets, and bucket_map assigns ranges of buckets to shards,
+    evenly by default. Adding a shard means changing bucket_map and moving the affected buckets with `manage.py reshard`.'''
+    def __init__(self, name: str, bot_token: Optional[str], stages_file: str, shards: list, buckets: int = BUCKETS, bucket_map: Optional[list] = None):
+        if not shards:
+            raise ValueError(f"Tenant {name} has no database shards")
+        bucket_map = bucket_map if bucket_map is not None else even_bucket_map(buckets, len(shards))
+        validate_bucket_map(bucket_map, buckets, len(shards))
+        self.name = name
+        self.bot_token = bot_token
+        self.stages_file = stages_file
+        self.shards = shards
+        self.buckets = buckets
+        self.bucket_map = bucket_map
+        self.pools: list[Optional[asyncpg.Pool]] = [None] * len(shards)
+        self.pools_lock: Optional[asyncio.Lock] = None # created on first use, inside the running event loop
+
+    def __repr__(self):
+        return f"Tenant(name={self.name}, stages_file={self.stages_file}, shards={len(self.shards)})"
+
+    def bucket_for(self, chat_id: int) -> int:
+        return chat_id % self.buckets
+
+    def shard_for(self, chat_id: int) -> int:
+        return bucket_shard(self.bucket_map, self.bucket_for(chat_id))
+
+    async def get_pool(self, shard: int) -> asyncpg.Pool:
+        '''Returns the connection pool of the given shard, creating it on first use'''
+        if self.pools[shard] is None:
+            if self.pools_lock is None:
+                self.pools_lock = asyncio.Lock()
+            async with self.pools_lock:
+                if self.pools[shard] is None:
+                    spec = self.shards[shard]
+                    log.debug(f"Creating connection pool for tenant {self.name}, shard {shard}")
+                    if isinstance(spec, str):
+                        self.pools[shard] = await asyncpg.create_pool(dsn=spec)
+                    else:
+                        self.pools[shard] = await asyncpg.create_pool(**spec)
+        return self.pools[shard]
+
+    async def close(self):
+        for pool in self.pools:
+            if pool is not None:
+                await pool.close()
+        self.pools = [None] * len(self.shards)
+        self.pools_lock = None
+
+def validate_bucket_map(bucket_map, buckets, shards):
+    firsts = [first for first, _ in bucket_map]
+    if not bucket_map or firsts[0] != 0 or firsts != sorted(set(firsts)) or firsts[-1] >= buckets:
+        raise ValueError(f"Bucket map {bucket_map} must be sorted by first bucket, start at 0 and stay below {buckets}")
+    for _, shard in bucket_map:
+        if not 0 <= shard < shards:
+            raise ValueError(f"Bucket map {bucket_map} refers to shard {shard}, but there are {shards} shards")
+
+def parse_tenant(dto):
+    return Tenant(
+        dto["name"], dto.get("bot_token"), dto.get("stages_file", cfg["stages_file"]), dto["shards"],
+        dto.get("buckets", BUCKETS), dto.get("bucket_map")
+    )
+
+tenants_ = None
+
+def load_tenants() -> list[Tenant]:
+    '''Loads tenants from the TENANTS_FILE json ({"tenants": [{"name": ..., "bot_token": ..., "stages_file": ..., "shards": [...], "bucket_map": [[0, 0], ...]}, ...]}).
+    Without it, a single "default" tenant is built from the DB_* and BOT_TOKEN environment variables.'''
+    global tenants_
+    if tenants_ is None:
+        if cfg["tenants_file"]:
+            with open(cfg["tenants_file"], 'r', encoding='utf-8') as file:
+                tenants_ = [parse_tenant(dto) for dto in json.load(file)["tenants"]]
+        else:
+            tenants_ = [Tenant("default", cfg["bot_token"], cfg["stages_file"], [{
+                "host": cfg["db_host"],
+                "port": cfg["db_port"],
+                "user": cfg["db_user"],
+                "database": cfg["db_name"],
+                "password": cfg["db_password"],
+            }])]
+    return tenants_
+
+def find_tenant(name: str) -> Tenant:
+    for tenant in load_tenants():
+        if tenant.name == name:
+            return tenant
+    raise KeyError(f"Tenant {name} not found")
+
+current_tenant: contextvars.ContextVar[Tenant] = contextvars.ContextVar("current_tenant")
+
+def get_tenant() -> Tenant:
+    '''Returns the tenant of the update being processed, or the first configured tenant outside of one'''
+    tenant = current_tenant.get(None)
+    return tenant if tenant is not None else load_tenants()[0]
@@ -0,0 +1,41 @@
+import pytest
+
+from utils.tenants import BUCKETS, Tenant, bucket_shard, even_bucket_map, parse_tenant
+
+def tenant(shards, **kwargs):
+    return Tenant("test", "token", "test_stages.json", [f"postgresql://db{i}" for i in range(shards)], **kwargs)
+
+def test_even_bucket_map():
+    assert even_bucket_map(1024, 1) == [[0, 0]]
+    assert even_bucket_map(1024, 4) == [[0, 0], [256, 1], [512, 2], [768, 3]]
+
+def test_bucket_shard():
+    bucket_map = [[0, 0], [100, 1], [500, 0]]
+    assert [bucket_shard(bucket_map, bucket) for bucket in (0, 99, 100, 499, 500, 1023)] == [0, 0, 1, 1, 0, 0]
+
+def test_shard_for_is_stable_and_in_range():
+    t = tenant(3)
+    for chat_id in (0, 1, 1023, 1024, 123456789, -1001234567890, -9 * 10 ** 15):
+        assert 0 <= t.bucket_for(chat_id) < BUCKETS
+        assert t.shard_for(chat_id) == bucket_shard(t.bucket_map, chat_id % BUCKETS)
+        assert 0 <= t.shard_for(chat_id) < 3
+
+def test_adding_shard_moves_only_remapped_buckets():
+    old = tenant(1)
+    new = tenant(2, bucket_map=[[0, 0], [768, 1]])
+    moved = [chat_id for chat_id in range(5000) if old.shard_for(chat_id) != new.shard_for(chat_id)]
+    assert moved and all(new.bucket_for(chat_id) >= 768 for chat_id in moved)
+
+@pytest.mark.parametrize("bucket_map", [[], [[1, 0]], [[0, 0], [0, 1]], [[0, 0], [2000, 0]], [[0, 2]]])
+def test_invalid_bucket_map(bucket_map):
+    with pytest.raises(ValueError):
+        tenant(2, bucket_map=bucket_map)
+
+def test_no_shards():
+    with pytest.raises(ValueError):
+        Tenant("test", "token", "test_stages.json", [])
+
+def test_tenant_without_bot_token_is_storage_only():
+    replay = parse_tenant({"name": "replay_db", "shards": ["postgresql://replay"]})
+    assert replay.bot_token is None
+    assert replay.shard_for(-9 * 10 ** 15) == 0